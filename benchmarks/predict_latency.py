@@ -0,0 +1,76 @@
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from services.ai.model_registry import predict_proba
+
+N_FEATURES = 140
+N_TRAINING_ROWS = 20_000
+BATCH_SIZES = [1, 50, 10_000]
+REPEATS = 200
+
+
+def get_synthetic_model() -> tuple[xgb.XGBClassifier, pd.DataFrame]:
+    """Model with the size of the production one, trained on random features"""
+    rng = np.random.default_rng(42)
+    x = pd.DataFrame(
+        rng.normal(size=(N_TRAINING_ROWS, N_FEATURES)).astype(np.float32),
+        columns=[f"feature_{i}" for i in range(N_FEATURES)],
+    )
+    y = (x.iloc[:, :10].sum(axis=1) + rng.normal(size=N_TRAINING_ROWS) > 0).astype(int)
+    model = xgb.XGBClassifier(
+        n_estimators=500,
+        max_depth=6,
+        learning_rate=0.05,
+        early_stopping_rounds=50,
+        eval_metric="auc",
+    )
+    model.fit(x, y, eval_set=[(x.iloc[-2000:], y.iloc[-2000:])], verbose=False)
+    return model, x
+
+
+def get_median_latency(predict, repeats: int) -> float:
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        predict()
+        latencies.append(time.perf_counter() - start)
+    return float(np.median(latencies))
+
+
+def run_benchmark():
+    model, x = get_synthetic_model()
+    booster = model.get_booster()
+    paths = dict(
+        xgb_classifier=lambda batch: model.predict_proba(batch)[:, 1],
+        dmatrix=lambda batch: predict_proba(booster, batch, backend="dmatrix"),
+        inplace=lambda batch: predict_proba(booster, batch, backend="inplace"),
+    )
+    results = []
+    for batch_size in BATCH_SIZES:
+        batch = x.iloc[:batch_size]
+        reference = paths["xgb_classifier"](batch)
+        repeats = max(5, REPEATS // max(1, batch_size // 100))
+        for path, predict in paths.items():
+            if not np.allclose(predict(batch), reference, atol=1e-6):
+                raise ValueError(f"{path} predictions differ from XGBClassifier")
+            latency = get_median_latency(lambda: predict(batch), repeats)
+            results.append(
+                dict(batch_size=batch_size, path=path, latency_ms=latency * 1000)
+            )
+    df = pd.DataFrame(results).pivot(
+        index="batch_size", columns="path", values="latency_ms"
+    )
+    df["inplace_speedup"] = df["xgb_classifier"] / df["inplace"]
+    print("Median prediction latency (ms):")
+    print(df.round(3).to_string())
+
+
+if __name__ == "__main__":
+    run_benchmark()
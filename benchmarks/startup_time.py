@@ -0,0 +1,76 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# entry point -> (module, import time budget in ms), about twice the import time
+# measured with every requirement installed (screener 1.0 s, training 2.3 s)
+ENTRY_POINTS = dict(
+    helpers=("utils.helpers", 250),
+    screener=("services.screening.main", 2000),
+    training=("services.ai.train", 4500),
+)
+REPEATS = 3
+
+
+def measure_import_time(module: str) -> tuple[float, list[tuple[str, float]]]:
+    """
+    Cumulative import time of the module in ms (python -X importtime, in a fresh
+    interpreter) and the cumulative time of each of its direct imports
+    """
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join([str(ROOT), str(ROOT / "services" / "screening")]),
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode:
+        # a missing dependency fails the benchmark as well, the budgets assume
+        # every requirement is installed
+        error = result.stderr.strip().splitlines()[-1]
+        raise RuntimeError(f"Could not import {module}: {error}")
+    direct_imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 0:
+            if name.strip() == module:
+                return int(cumulative) / 1000, direct_imports
+            direct_imports = []
+        elif depth == 1:
+            direct_imports.append((name.strip(), int(cumulative) / 1000))
+    raise RuntimeError(f"{module} not found in the import times")
+
+
+def run_benchmark() -> bool:
+    within_budget = True
+    for entry_point, (module, budget) in ENTRY_POINTS.items():
+        try:
+            measures = [measure_import_time(module) for _ in range(REPEATS)]
+        except RuntimeError as e:
+            print(f"{entry_point}: {e}")
+            within_budget = False
+            continue
+        import_time, direct_imports = min(measures, key=lambda measure: measure[0])
+        status = "OK" if import_time <= budget else "OVER BUDGET"
+        print(
+            f"{entry_point} ({module}): {import_time:,.0f} ms / {budget:,} ms {status}"
+        )
+        within_budget &= import_time <= budget
+        heaviest = sorted(direct_imports, key=lambda item: item[1], reverse=True)
+        for name, cumulative in heaviest[:5]:
+            print(f"    {name}: {cumulative:,.0f} ms")
+    return within_budget
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run_benchmark() else 1)
@@ -1,31 +1,50 @@
 import asyncio
-import pickle
 from typing import Literal
 
+import numpy as np
 import pandas as pd
+import xgboost as xgb
 from xgboost import XGBClassifier
 
+from services.ai.model_registry import MODEL_REGISTRY, predict_proba
 from services.ai.train import Train
-from utils.helpers import write_file_to_s3, load_from_s3
+from utils.helpers import write_file_to_s3
 
 
 class BackTest(Train):
     backtest_df: pd.DataFrame
     backtest_x: pd.DataFrame
     backtest_y: pd.Series
+    predictions_df: pd.DataFrame
+    backtest_results: pd.DataFrame
+    portfolio_results: pd.DataFrame
+
+    # trading costs, charged on both entry and exit of every trade
+    fee_rate: float = 0.001
+    slippage: float = 0.0005
+
+    prediction_backend: Literal["dmatrix", "inplace"] = "inplace"
+
+    # upper bound on the thresholds x rows matrix evaluated at once
+    max_sweep_cells: int = 10_000_000
 
     def __init__(
         self, target_type: Literal["take_profit", "stop_loss"], pairs: list[str]
     ):
         super().__init__(target_type=target_type)
         self.pairs = pairs
+        self.model = None
+        self.predictions_df = None
         # self.reset()
 
     async def get_backtesting_df(self):
         await self.pre_process_data(pairs=self.pairs)
+        # restricts the training columns to the features of the saved model
+        self.selected_features = self.load_feature_manifest()
         self.split()
         self.backtest_df = self.datasets["test"]["df"]
         _, _, _, _, self.backtest_x, self.backtest_y = self.get_datasets()
+        self.predictions_df = None
 
     def transform_ohlcv(self):
         self.log.info("Transforming OHLCV")
@@ -40,17 +59,29 @@ class BackTest(Train):
         )
         self.pair_df["volume"] = self.pair_df["volume"] * self.pair_df["close"]
 
-    def align_in_time(self):
-        final_df = pd.DataFrame()
-        for pair in self.backtest_df["pair"].unique().tolist():
-            pair_df = self.backtest_df[self.backtest_df["pair"] == pair]
+    def align_in_time(self, df: pd.DataFrame, shift_cols: list[str]) -> pd.DataFrame:
+        df = df.sort_values(by=["pair", "calendar_dt"], kind="stable")
+        df = df.reset_index(drop=True)
+        df[shift_cols] = self.grouped_shift(df, shift_cols).fillna(0)
+        return df
+
+    def load_model(self) -> xgb.Booster:
+        if self.model is None:
+            self.model = MODEL_REGISTRY.load(self.model_name)
+        return self.model
+
+    def get_predictions(self) -> pd.DataFrame:
+        """Test set predictions, shifted to the day they are traded, computed once"""
+        if self.predictions_df is None:
             target_col = self.get_training_columns(col_type="target")[0]
-            for shift_col in ["prediction", "model_buy", target_col]:
-                pair_df[shift_col] = pair_df[shift_col].shift(1).fillna(0)
-            final_df = pd.concat([final_df, pair_df])
-        self.backtest_df = final_df.sort_values(by=["pair", "calendar_dt"]).reset_index(
-            drop=True
-        )
+            df = self.backtest_df[self.backtest_columns + [target_col]].assign(
+                prediction=predict_proba(
+                    self.load_model(), self.backtest_x, self.prediction_backend
+                )
+            )
+            df = self.align_in_time(df, ["prediction", target_col])
+            self.predictions_df = df.iloc[:-1]
+        return self.predictions_df
 
     def backtest(
         self,
@@ -58,30 +89,89 @@ class BackTest(Train):
         model: XGBClassifier = None,
         confidence_threshold: float = 0.5,
     ) -> float:
-        self.reset_balance()
-        load_from_s3(f"{self.model_name}.pkl")
-        model = pickle.load(open(self.model_path, "rb"))
-        self.backtest_df.insert(
-            0,
-            "prediction",
-            model.predict_proba(self.backtest_x)[:, 1],
-        )
-        self.backtest_df.insert(
-            0,
-            "model_buy",
-            self.backtest_df["prediction"] > confidence_threshold,
-        )
-        self.align_in_time()
-        self.backtest_df.drop(self.backtest_df.tail(1).index, inplace=True)
-        self.backtest_df.replace({True: 1, False: 0}, inplace=True)
-        self.backtest_df.insert(0, "pnl", self.backtest_df.apply(self.get_pnl, axis=1))
-        self.backtest_df.insert(
-            0, "usd_pnl", self.backtest_df.apply(self.update_balance, axis=1)
+        df = self.get_predictions().copy()
+        df.insert(0, "model_buy", df["prediction"] > confidence_threshold)
+        pnl = self.get_pnl(df)
+        equity_curve = self.update_balance(pnl)
+        df.insert(0, "pnl", pnl)
+        df.insert(0, "usd_pnl", np.diff(equity_curve, prepend=self.starting_balance))
+        df.insert(0, "cumulative_pnl", equity_curve - self.starting_balance)
+        self.backtest_results = df
+        if df.empty:
+            return 0.0
+        return float(equity_curve[-1] / self.starting_balance - 1)
+
+    def sweep_confidence_thresholds(self, thresholds: np.ndarray) -> pd.DataFrame:
+        """
+        Final P&L for every confidence threshold from a single prediction pass:
+        trades are evaluated on a thresholds x rows matrix, in chunks of thresholds
+        so that the matrix stays below max_sweep_cells.
+        """
+        df = self.get_predictions()
+        thresholds = np.asarray(thresholds, dtype=np.float64)
+        predictions = df["prediction"].to_numpy(dtype=np.float64)
+        trade_growth = 1 + self.get_pnl(df.assign(model_buy=True))
+        chunk_size = max(1, self.max_sweep_cells // max(len(df), 1))
+        final_pnl = np.empty(len(thresholds))
+        for start in range(0, len(thresholds), chunk_size):
+            chunk = thresholds[start : start + chunk_size]
+            model_buy = predictions[np.newaxis, :] > chunk[:, np.newaxis]
+            growth = np.where(model_buy, trade_growth[np.newaxis, :], 1.0)
+            final_pnl[start : start + chunk_size] = growth.prod(axis=1) - 1
+        return pd.DataFrame(dict(threshold=thresholds, final_pnl=final_pnl))
+
+    @staticmethod
+    def get_portfolio_weights(
+        df: pd.DataFrame,
+        day_codes: np.ndarray,
+        weighting: Literal["equal", "confidence"],
+    ) -> np.ndarray:
+        """Share of the day's capital allocated to each of the day's buy signals"""
+        if weighting == "equal":
+            scores = np.where(df["model_buy"], 1.0, 0.0)
+        elif weighting == "confidence":
+            scores = np.where(df["model_buy"], df["prediction"], 0.0)
+        else:
+            raise ValueError(f"Unknown weighting: {weighting}")
+        day_totals = np.bincount(day_codes, weights=scores)[day_codes]
+        return np.divide(
+            scores, day_totals, out=np.zeros_like(scores), where=day_totals > 0
         )
-        self.backtest_df.insert(
-            0, "cumulative_pnl", self.backtest_df["usd_pnl"].cumsum()
+
+    def portfolio_backtest(
+        self,
+        confidence_threshold: float = 0.5,
+        weighting: Literal["equal", "confidence"] = "equal",
+        capital_fraction: float = 1,
+    ) -> float:
+        """
+        Trades of the same day share the capital instead of compounding one after
+        the other: each day, capital_fraction of the balance is split across the
+        day's buy signals, trading costs are deducted from every trade and the
+        balance compounds once per day.
+        """
+        df = self.get_predictions()
+        df = df.assign(model_buy=df["prediction"] > confidence_threshold)
+        day_codes, days = pd.factorize(df["calendar_dt"], sort=True)
+        trading_costs = 2 * (self.fee_rate + self.slippage)
+        net_pnl = np.where(df["model_buy"], self.get_pnl(df) - trading_costs, 0.0)
+        weights = self.get_portfolio_weights(df, day_codes, weighting)
+        day_pnl = np.bincount(day_codes, weights=weights * net_pnl, minlength=len(days))
+        equity_curve = self.update_balance(day_pnl, weight=capital_fraction)
+        self.portfolio_results = pd.DataFrame(
+            dict(
+                calendar_dt=days,
+                trades=np.bincount(
+                    day_codes[df["model_buy"].to_numpy()], minlength=len(days)
+                ),
+                day_pnl=day_pnl * capital_fraction,
+                usd_pnl=np.diff(equity_curve, prepend=self.starting_balance),
+                balance=equity_curve,
+            )
         )
-        return (self.balance / self.starting_balance) - 1
+        if not len(equity_curve):
+            return 0.0
+        return float(equity_curve[-1] / self.starting_balance - 1)
 
 
 async def run_backtest(
@@ -90,15 +180,11 @@ async def run_backtest(
     backtest = BackTest(target_type="take_profit", pairs=pairs)
     await backtest.get_backtesting_df()
     threshold_range = range(1, 101) if test_multiple_confidence_thresholds else [50]
-    data = list()
+    df = backtest.sweep_confidence_thresholds(np.array(threshold_range) / 100)
     metadata_content = "\n\nBACKTESTING RESULTS:\n"
-    for threshold in threshold_range:
-        threshold /= 100
-        final_pnl = backtest.backtest(confidence_threshold=threshold)
-        data.append(dict(threshold=threshold, final_pnl=final_pnl))
+    for threshold, final_pnl in df.itertuples(index=False):
         print(f"Threshold {threshold:,.0%} -> Final P&L is {final_pnl:,.2%}")
         metadata_content += f"- {threshold:,.0%}: {final_pnl:,.2%}\n"
-    df = pd.DataFrame(data)
     df.to_csv(f"{backtest.assets_path}/confidence_thresholds_results.csv")
     write_file_to_s3(
         local_path=f"{backtest.assets_path}/{backtest.model_name}_metadata.txt",
@@ -0,0 +1,415 @@
+import asyncio
+import copy
+
+import numpy as np
+import pandas as pd
+
+
+class FeatureGroup:
+    """
+    A stage of Indicators: the method computing it, the columns it reads (inputs),
+    adds or overwrites (outputs) and removes (drops), and the number of past bars
+    its latest value depends on (warmup). writes_datasets marks the groups changing
+    the cached datasets in place rather than only adding new ones.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        method: str,
+        inputs: list[str],
+        outputs: list[str],
+        drops: list[str] = None,
+        warmup: int = 0,
+        after: list[str] = None,
+        exclusive: bool = False,
+        dynamic_outputs: str = None,
+        subset_param: str = None,
+        writes_datasets: bool = False,
+    ):
+        self.name = name
+        self.method = method
+        self.inputs = inputs
+        self.outputs = outputs
+        self.drops = drops if drops else []
+        self.warmup = warmup
+        self.after = after if after else []
+        # changes the rows of the frame, runs alone before every other group
+        self.exclusive = exclusive
+        # Indicators attribute listing configurable outputs, and the parameter of the
+        # method restricting them to the required ones
+        self.dynamic_outputs = dynamic_outputs
+        self.subset_param = subset_param
+        self.writes_datasets = writes_datasets
+
+    def get_outputs(self, indicators) -> list[str]:
+        if self.dynamic_outputs:
+            return self.outputs + getattr(indicators, self.dynamic_outputs)
+        return self.outputs
+
+    def depends_on(self, other: "FeatureGroup", indicators) -> bool:
+        """other comes first in the registry and must be computed before this group"""
+        other_outputs = other.get_outputs(indicators)
+        outputs = self.get_outputs(indicators) + self.drops
+        return (
+            other.name in self.after
+            # reads a column other adds or overwrites
+            or any(col in other_outputs for col in self.inputs)
+            # overwrites or drops a column other reads
+            or any(col in outputs for col in other.inputs)
+        )
+
+
+class FeatureRegistry:
+    """
+    Feature groups in the order of the original serial pipeline. Only the groups
+    producing the required features (and the groups they depend on) are computed,
+    independent groups run concurrently on the columns they declare and their
+    columns are combined back in registry order.
+    """
+
+    def __init__(self, groups: list[FeatureGroup]):
+        self.groups = groups
+
+    def select(self, indicators, required: list[str] = None) -> list[FeatureGroup]:
+        if required is None:
+            return list(self.groups)
+        selected = {
+            group.name
+            for group in self.groups
+            if group.exclusive
+            or any(col in required for col in group.get_outputs(indicators))
+        }
+        for i in reversed(range(len(self.groups))):
+            group = self.groups[i]
+            if group.name not in selected:
+                continue
+            for other in self.groups[:i]:
+                if other.name not in selected and group.depends_on(other, indicators):
+                    selected.add(other.name)
+        return [group for group in self.groups if group.name in selected]
+
+    @staticmethod
+    def get_levels(groups: list[FeatureGroup], indicators) -> list[list[FeatureGroup]]:
+        """Groups of a level only depend on groups of the previous levels"""
+        levels = dict()
+        for i, group in enumerate(groups):
+            levels[group.name] = 1 + max(
+                (
+                    levels[other.name]
+                    for other in groups[:i]
+                    if group.depends_on(other, indicators)
+                ),
+                default=-1,
+            )
+        return [
+            [group for group in groups if levels[group.name] == level]
+            for level in range(max(levels.values(), default=-1) + 1)
+        ]
+
+    def get_warmup(self, indicators, required: list[str] = None) -> int:
+        """Past bars needed for the latest value of every required feature"""
+        groups = self.select(indicators, required)
+        return max((group.warmup for group in groups), default=0)
+
+    @staticmethod
+    async def call(indicators, group: FeatureGroup, required: list[str] = None):
+        """
+        Coroutine methods run on the caller's event loop (and its pooled clients),
+        the others in a worker thread
+        """
+        kwargs = dict()
+        if group.subset_param and required is not None:
+            kwargs[group.subset_param] = [
+                col
+                for col in getattr(indicators, group.dynamic_outputs)
+                if col in required
+            ]
+        method = getattr(indicators, group.method)
+        if asyncio.iscoroutinefunction(method):
+            await method(**kwargs)
+        else:
+            await asyncio.to_thread(method, **kwargs)
+
+    @staticmethod
+    def get_group_columns(indicators, group: FeatureGroup, df: pd.DataFrame):
+        """Columns of df the group reads, overwrites or drops"""
+        declared = group.inputs + group.get_outputs(indicators) + group.drops
+        return [col for col in df if col in declared]
+
+    async def compute(
+        self,
+        indicators,
+        group: FeatureGroup,
+        group_input: pd.DataFrame,
+        required: list[str],
+    ) -> tuple[pd.DataFrame, dict]:
+        """
+        Runs the group on its own frame of the columns it declares, and on its own
+        mapping of the cached datasets (copied as well when the group writes to
+        them): concurrent groups share no mutable state (raw_data is only read)
+        """
+        worker = copy.copy(indicators)
+        worker.pair_df = group_input
+        if group.writes_datasets:
+            worker.datasets = copy.deepcopy(indicators.datasets)
+        else:
+            worker.datasets = dict(indicators.datasets)
+        await self.call(worker, group, required)
+        return worker.pair_df, worker.datasets
+
+    @staticmethod
+    def check_output(
+        group: FeatureGroup, group_input: pd.DataFrame, group_output: pd.DataFrame
+    ):
+        """
+        A group keeps the rows of its input, and only changes the columns it
+        declares as outputs or drops
+        """
+        if len(group_output) != len(group_input):
+            raise ValueError(
+                f"Feature group {group.name} returned {len(group_output)} rows "
+                f"instead of {len(group_input)}"
+            )
+        undeclared = [
+            col
+            for col in group.inputs
+            if col in group_input
+            and col not in group.outputs
+            and col not in group.drops
+            and (
+                col not in group_output
+                or not np.array_equal(
+                    group_output[col].to_numpy(),
+                    group_input[col].to_numpy(),
+                    equal_nan=group_input[col].dtype.kind == "f",
+                )
+            )
+        ]
+        if undeclared:
+            raise ValueError(
+                f"Feature group {group.name} changed undeclared columns {undeclared}"
+            )
+
+    @staticmethod
+    def combine(
+        df: pd.DataFrame,
+        results: list[tuple[FeatureGroup, list[str], pd.DataFrame]],
+    ) -> pd.DataFrame:
+        """
+        Applies the columns every group added, overwrote and dropped, rows are
+        matched by position (merges reset the index, check_output ensures that
+        the rows are kept)
+        """
+        added = [df]
+        overwritten = dict()
+        dropped = []
+        for group, group_columns, group_output in results:
+            group_output = group_output.set_axis(df.index)
+            new_cols = [col for col in group_output if col not in group_columns]
+            added.append(group_output[new_cols])
+            for col in group.outputs:
+                if col in group_columns and col in group_output:
+                    overwritten[col] = group_output[col]
+            dropped.extend(group.drops)
+        df = pd.concat(added, axis=1)
+        for col, values in overwritten.items():
+            df[col] = values
+        return df.drop(columns=dropped)
+
+    async def run(self, indicators, required: list[str] = None):
+        """Computes the required features on indicators.pair_df"""
+        groups = self.select(indicators, required)
+        for group in groups:
+            if group.exclusive:
+                await self.call(indicators, group, required)
+        groups = [group for group in groups if not group.exclusive]
+        base_df = df = indicators.pair_df
+        results = dict()
+        for level in self.get_levels(groups, indicators):
+            level_columns = [
+                self.get_group_columns(indicators, group, df) for group in level
+            ]
+            # selecting the columns copies them, df itself is left untouched
+            outputs = await asyncio.gather(
+                *[
+                    self.compute(indicators, group, df[group_columns], required)
+                    for group, group_columns in zip(level, level_columns)
+                ]
+            )
+            level_results = []
+            for group, group_columns, (output, datasets) in zip(
+                level, level_columns, outputs
+            ):
+                self.check_output(group, df, output)
+                level_results.append((group, group_columns, output))
+                results[group.name] = (group, group_columns, output)
+                # datasets the group loaded are cached for the next pairs
+                for name, dataset in datasets.items():
+                    indicators.datasets.setdefault(name, dataset)
+            df = self.combine(df, level_results)
+        # canonical column order: the one of the serial pipeline
+        indicators.pair_df = self.combine(
+            base_df, [results[group.name] for group in groups]
+        ).reset_index(drop=True)
+
+
+FEATURE_REGISTRY = FeatureRegistry(
+    [
+        FeatureGroup(
+            name="target",
+            method="add_target",
+            inputs=["open", "high", "low", "close"],
+            outputs=["hit_take_profit", "hit_stop_loss"],
+            exclusive=True,
+        ),
+        FeatureGroup(
+            name="trend",
+            method="add_trend_indicators",
+            inputs=["pair", "high", "low", "close"],
+            outputs=[
+                "sma_50",
+                "sma_200",
+                "ema_100",
+                "short_term_trend",
+                "sar_signal",
+                "ichimoku_trend",
+                "ichimoku_tenkan_signal",
+                "ichimoku_cloud_signal",
+                "distance_to_ichimoku_cloud_bottom",
+                "distance_to_ichimoku_cloud_top",
+                "adx_signal",
+            ],
+            warmup=200,
+        ),
+        FeatureGroup(
+            name="price",
+            method="add_price_indicators",
+            inputs=["high", "low", "close", "fractal_resistance", "fractal_support"],
+            outputs=[
+                "1d_return",
+                "7d_return",
+                "30d_return",
+                "has_crossed_fractal_resistance",
+                "has_crossed_fractal_support",
+                "distance_to_fractal_resistance",
+                "distance_to_fractal_support",
+            ],
+            drops=["fractal_resistance", "fractal_support"],
+            warmup=30,
+        ),
+        FeatureGroup(
+            name="derivatives",
+            method="add_derivatives_indicators",
+            inputs=["calendar_dt"],
+            outputs=[
+                "btc_usd_open_interest",
+                "btc_usd_funding_rate",
+                "longs_liquidations",
+                "shorts_liquidations",
+                "ls_ratio",
+            ],
+        ),
+        FeatureGroup(
+            name="momentum",
+            method="add_momentum_indicators",
+            inputs=["high", "low", "close"],
+            outputs=["rsi", "macd_signal", "macd_hist", "stochastic_signal"],
+            warmup=35,
+        ),
+        FeatureGroup(
+            name="volatility",
+            method="add_volatility_indicators",
+            inputs=["calendar_dt", "high", "low", "close", "1d_return"],
+            outputs=[
+                "historical_volatility",
+                "high_low_volatility",
+                "greed_and_fear_index",
+                "greed_and_fear_index_change",
+                "vix_1d_return",
+                "vix",
+                "bollinger_spread",
+                "distance_to_bollinger_upper",
+                "distance_to_bollinger_lower",
+                "distance_to_bollinger_middle",
+            ],
+            warmup=15,
+        ),
+        FeatureGroup(
+            name="volume",
+            method="add_volume_indicators",
+            inputs=[
+                "pair",
+                "high",
+                "low",
+                "close",
+                "usd_volume",
+                "poc_support",
+                "poc_resistance",
+            ],
+            outputs=[
+                "volume_sma_50",
+                "has_crossed_poc_resistance",
+                "has_crossed_poc_support",
+                "distance_to_poc_support",
+                "distance_to_poc_resistance",
+                "obv_change",
+                "obv_breakout_signal",
+            ],
+            drops=["poc_support", "poc_resistance"],
+            warmup=64,
+        ),
+        FeatureGroup(
+            name="market_beta",
+            method="add_market_beta_indicators",
+            inputs=["calendar_dt"],
+            outputs=[
+                "bitcoin_dominance",
+                "btc_return_1d",
+                "btc_return_7d",
+                "btc_return_30d",
+                "btc_eth_correlation",
+                "gold_1d_return",
+                "nasdaq_1d_return",
+            ],
+            warmup=30,
+        ),
+        FeatureGroup(
+            name="macro",
+            method="add_macro_indicators",
+            inputs=["calendar_dt"],
+            outputs=[
+                "nfp_actual",
+                "nfp_forecast",
+                "nfp_previous",
+                "days_to_next_nfp",
+                "fed_actual",
+                "fed_forecast",
+                "fed_previous",
+                "days_to_next_fed_decisions",
+            ],
+            # converts the dates of the cached nfp and fed_decisions datasets
+            writes_datasets=True,
+        ),
+        FeatureGroup(
+            name="seasonality",
+            method="add_seasonality",
+            inputs=["calendar_dt"],
+            outputs=[
+                "calendar_dt",
+                "day_of_week",
+                "month_of_year",
+                "days_to_quarter_end",
+            ],
+        ),
+        FeatureGroup(
+            name="patterns",
+            method="add_patterns",
+            inputs=["open", "high", "low", "close", "sma_50", "sma_200"],
+            outputs=["death_cross"],
+            warmup=15,
+            dynamic_outputs="candlestick_patterns",
+            subset_param="patterns",
+        ),
+    ]
+)
@@ -0,0 +1,89 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+
+class EMAState:
+    """talib.EMA updated one bar at a time: SMA seed over the first bars, then EMA"""
+
+    def __init__(self, timeperiod: int):
+        self.timeperiod = timeperiod
+        self.k = 2 / (timeperiod + 1)
+        self.seed_sum = 0.0
+        self.seed_count = 0
+        self.value = math.nan
+
+    def update(self, close: float) -> float:
+        if self.seed_count < self.timeperiod:
+            self.seed_sum += close
+            self.seed_count += 1
+            if self.seed_count == self.timeperiod:
+                self.value = self.seed_sum / self.timeperiod
+        else:
+            self.value += self.k * (close - self.value)
+        return self.value
+
+
+class OBVState:
+    """talib.OBV updated one bar at a time"""
+
+    def __init__(self):
+        self.value = math.nan
+        self.last_close = math.nan
+
+    def update(self, close: float, volume: float) -> float:
+        if math.isnan(self.value):
+            self.value = volume
+        elif close > self.last_close:
+            self.value += volume
+        elif close < self.last_close:
+            self.value -= volume
+        self.last_close = close
+        return self.value
+
+
+class PairBuffer:
+    """
+    Last max_bars raw bars of a pair, with the running state of the indicators
+    whose value depends on the whole history (EMA 100 warm-up, OBV level). The
+    other indicators only look back a bounded number of bars and are recomputed
+    on the buffered bars.
+    """
+
+    def __init__(self, max_bars: int):
+        self.max_bars = max_bars
+        self.bars = pd.DataFrame()
+        self.ema_100 = EMAState(timeperiod=100)
+        self.obv = OBVState()
+        self.ema_100_values = np.array([])
+        self.obv_values = np.array([])
+
+    @property
+    def last_date(self):
+        return self.bars["calendar_dt"].iloc[-1]
+
+    def append(self, bars: pd.DataFrame):
+        """O(1) state update per new bar, bars already buffered are ignored"""
+        if not self.bars.empty:
+            bars = bars[bars["calendar_dt"] > self.last_date]
+        if bars.empty:
+            return
+        ema_100_values = [self.ema_100.update(close) for close in bars["close"]]
+        obv_values = [
+            self.obv.update(close, volume)
+            for close, volume in zip(bars["close"], bars["usd_volume"])
+        ]
+        self.bars = pd.concat([self.bars, bars]).iloc[-self.max_bars :]
+        self.ema_100_values = np.append(self.ema_100_values, ema_100_values)[
+            -self.max_bars :
+        ]
+        self.obv_values = np.append(self.obv_values, obv_values)[-self.max_bars :]
+
+    @property
+    def obv_offset(self) -> float:
+        """
+        talib.OBV restarts from the first buffered bar's volume, the offset brings
+        it back to the full history level
+        """
+        return self.obv_values[0] - self.bars["usd_volume"].iloc[0]
@@ -1,5 +1,6 @@
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime
 from time import time
 from typing import Literal
@@ -7,13 +8,14 @@ from typing import Literal
 import numpy as np
 import pandas as pd
 import pandas_ta
-import requests
 import talib
 import yfinance as yf
 
+from services.ai.features import FEATURE_REGISTRY
 from services.screening.indicators.fractals import FractalCandlestickPattern
 from services.screening.indicators.vbp import get_vbp
 from utils.helpers import get_db_connection
+from utils.pools import get_json
 
 START_DATE = date(2015, 7, 21)
 
@@ -25,6 +27,80 @@ class Indicators:
 
     stop_loss: float = -0.02
     take_profit: float = 0.03
+    # inference needs the latest day, whose target is not known yet
+    keep_unlabelled_rows: bool = False
+    # per pair state carried over from bars that are not part of the data, when
+    # indicators are computed on the last bars only (see services/ai/incremental.py)
+    obv_offsets: dict[str, float]
+    ema_100_values: dict[str, np.ndarray]
+
+    # TA-Lib candlestick patterns added as features, trim to skip unused ones
+    candlestick_patterns: list[str] = [
+        "CDL2CROWS",
+        "CDL3BLACKCROWS",
+        "CDL3INSIDE",
+        "CDL3LINESTRIKE",
+        "CDL3OUTSIDE",
+        "CDL3STARSINSOUTH",
+        "CDL3WHITESOLDIERS",
+        "CDLABANDONEDBABY",
+        "CDLADVANCEBLOCK",
+        "CDLBELTHOLD",
+        "CDLBREAKAWAY",
+        "CDLCLOSINGMARUBOZU",
+        "CDLCONCEALBABYSWALL",
+        "CDLCOUNTERATTACK",
+        "CDLDARKCLOUDCOVER",
+        "CDLDOJI",
+        "CDLDOJISTAR",
+        "CDLDRAGONFLYDOJI",
+        "CDLENGULFING",
+        "CDLEVENINGDOJISTAR",
+        "CDLEVENINGSTAR",
+        "CDLGAPSIDESIDEWHITE",
+        "CDLGRAVESTONEDOJI",
+        "CDLHAMMER",
+        "CDLHANGINGMAN",
+        "CDLHARAMI",
+        "CDLHARAMICROSS",
+        "CDLHIGHWAVE",
+        "CDLHIKKAKE",
+        "CDLHIKKAKEMOD",
+        "CDLHOMINGPIGEON",
+        "CDLIDENTICAL3CROWS",
+        "CDLINNECK",
+        "CDLINVERTEDHAMMER",
+        "CDLKICKING",
+        "CDLKICKINGBYLENGTH",
+        "CDLLADDERBOTTOM",
+        "CDLLONGLEGGEDDOJI",
+        "CDLLONGLINE",
+        "CDLMARUBOZU",
+        "CDLMATCHINGLOW",
+        "CDLMATHOLD",
+        "CDLMORNINGDOJISTAR",
+        "CDLMORNINGSTAR",
+        "CDLONNECK",
+        "CDLPIERCING",
+        "CDLRICKSHAWMAN",
+        "CDLRISEFALL3METHODS",
+        "CDLSEPARATINGLINES",
+        "CDLSHOOTINGSTAR",
+        "CDLSHORTLINE",
+        "CDLSPINNINGTOP",
+        "CDLSTALLEDPATTERN",
+        "CDLSTICKSANDWICH",
+        "CDLTAKURI",
+        "CDLTASUKIGAP",
+        "CDLTHRUSTING",
+        "CDLTRISTAR",
+        "CDLUNIQUE3RIVER",
+        "CDLUPSIDEGAP2CROWS",
+        "CDLXSIDEGAP3METHODS",
+    ]
+    pattern_workers: int = min(4, os.cpu_count() or 1)
+    # features to compute (with the groups they depend on), all of them when None
+    required_features: list[str] = None
 
     def __init__(
         self,
@@ -34,16 +110,78 @@ class Indicators:
         self.log = self.get_logger()
         self.db = get_db_connection()
         self.datasets = dict()
+        self.obv_offsets = dict()
+        self.ema_100_values = dict()
 
     @staticmethod
     def get_logger() -> logging.Logger:
         logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
         return logging.getLogger("training-dataset")
 
+    @staticmethod
+    def get_compact_dtypes(
+        df: pd.DataFrame,
+        with_floats: bool = False,
+        float64_columns: list[str] = None,
+        float32_columns: list[str] = None,
+    ) -> dict:
+        """
+        - Integer columns (patterns, signals, flags): smallest integer type holding
+          their range
+        - Float columns: float32 when every value round trips exactly, the ones in
+          float32_columns (whose precision doesn't matter) as long as they stay in
+          float32's range
+        """
+        dtypes = dict()
+        for col in df.select_dtypes(include="integer").columns:
+            col_min, col_max = df[col].min(), df[col].max()
+            for dtype in (np.int8, np.int16, np.int32):
+                if np.iinfo(dtype).min <= col_min and col_max <= np.iinfo(dtype).max:
+                    dtypes[col] = dtype
+                    break
+        if with_floats:
+            float64_columns = float64_columns if float64_columns else []
+            float32_columns = float32_columns if float32_columns else []
+            for col in df.select_dtypes(include="float64").columns:
+                if col in float64_columns:
+                    continue
+                values = df[col].to_numpy()
+                with np.errstate(over="ignore"):
+                    downcast_values = values.astype(np.float32)
+                if col in float32_columns:
+                    # rounded, but no finite value may overflow to inf
+                    is_in_range = np.array_equal(
+                        np.isfinite(downcast_values), np.isfinite(values)
+                    )
+                    if is_in_range:
+                        dtypes[col] = np.float32
+                elif np.array_equal(downcast_values, values, equal_nan=True):
+                    dtypes[col] = np.float32
+        return {col: dtype for col, dtype in dtypes.items() if df[col].dtype != dtype}
+
+    @staticmethod
+    def grouped_shift(
+        df: pd.DataFrame,
+        columns: list[str],
+        periods: int = 1,
+        fill_value=None,
+        by: str = "pair",
+    ) -> pd.DataFrame:
+        """
+        Lags (periods > 0) or leads (periods < 0) columns within each pair, so that
+        values never leak from one pair to the next. df must be sorted by date
+        within each pair.
+        """
+        return df.groupby(by, observed=True, sort=False)[columns].shift(
+            periods, fill_value=fill_value
+        )
+
     def update_table(self, table_name: str):
         pass
 
-    def load_training_dataset(self, pairs: list[str] = None) -> pd.DataFrame:
+    def load_training_dataset(
+        self, pairs: list[str] = None, from_date: date = None
+    ) -> pd.DataFrame:
         pass
 
     def compute_key_levels(self):
@@ -106,80 +244,31 @@ class Indicators:
                 periods=period
             )
 
-    def add_patterns(self):
+    def add_patterns(self, patterns: list[str] = None):
         # https://github.com/TA-Lib/ta-lib-python/blob/master/docs/func_groups/pattern_recognition.md
         self.log.info("Adding trading patterns")
         self.add_death_cross_pattern()
-        pattern_list = [
-            "CDL2CROWS",
-            "CDL3BLACKCROWS",
-            "CDL3INSIDE",
-            "CDL3LINESTRIKE",
-            "CDL3OUTSIDE",
-            "CDL3STARSINSOUTH",
-            "CDL3WHITESOLDIERS",
-            "CDLABANDONEDBABY",
-            "CDLADVANCEBLOCK",
-            "CDLBELTHOLD",
-            "CDLBREAKAWAY",
-            "CDLCLOSINGMARUBOZU",
-            "CDLCONCEALBABYSWALL",
-            "CDLCOUNTERATTACK",
-            "CDLDARKCLOUDCOVER",
-            "CDLDOJI",
-            "CDLDOJISTAR",
-            "CDLDRAGONFLYDOJI",
-            "CDLENGULFING",
-            "CDLEVENINGDOJISTAR",
-            "CDLEVENINGSTAR",
-            "CDLGAPSIDESIDEWHITE",
-            "CDLGRAVESTONEDOJI",
-            "CDLHAMMER",
-            "CDLHANGINGMAN",
-            "CDLHARAMI",
-            "CDLHARAMICROSS",
-            "CDLHIGHWAVE",
-            "CDLHIKKAKE",
-            "CDLHIKKAKEMOD",
-            "CDLHOMINGPIGEON",
-            "CDLIDENTICAL3CROWS",
-            "CDLINNECK",
-            "CDLINVERTEDHAMMER",
-            "CDLKICKING",
-            "CDLKICKINGBYLENGTH",
-            "CDLLADDERBOTTOM",
-            "CDLLONGLEGGEDDOJI",
-            "CDLLONGLINE",
-            "CDLMARUBOZU",
-            "CDLMATCHINGLOW",
-            "CDLMATHOLD",
-            "CDLMORNINGDOJISTAR",
-            "CDLMORNINGSTAR",
-            "CDLONNECK",
-            "CDLPIERCING",
-            "CDLRICKSHAWMAN",
-            "CDLRISEFALL3METHODS",
-            "CDLSEPARATINGLINES",
-            "CDLSHOOTINGSTAR",
-            "CDLSHORTLINE",
-            "CDLSPINNINGTOP",
-            "CDLSTALLEDPATTERN",
-            "CDLSTICKSANDWICH",
-            "CDLTAKURI",
-            "CDLTASUKIGAP",
-            "CDLTHRUSTING",
-            "CDLTRISTAR",
-            "CDLUNIQUE3RIVER",
-            "CDLUPSIDEGAP2CROWS",
-            "CDLXSIDEGAP3METHODS",
+        patterns = self.candlestick_patterns if patterns is None else patterns
+        ohlc = [
+            np.ascontiguousarray(self.pair_df[col].to_numpy(dtype=np.float64))
+            for col in ("open", "high", "low", "close")
         ]
-        for pattern in pattern_list:
-            self.pair_df[pattern] = getattr(talib, pattern)(
-                self.pair_df["open"],
-                self.pair_df["high"],
-                self.pair_df["low"],
-                self.pair_df["close"],
-            )
+        # confirmed patterns are flagged with ±200, which does not fit in int8
+        matches = np.empty((len(self.pair_df), len(patterns)), dtype=np.int16)
+
+        def add_pattern(position: int, pattern: str):
+            matches[:, position] = getattr(talib, pattern)(*ohlc)
+
+        # TA-Lib releases the GIL, patterns are computed concurrently
+        with ThreadPoolExecutor(max_workers=self.pattern_workers) as executor:
+            list(executor.map(add_pattern, range(len(patterns)), patterns))
+        self.pair_df = pd.concat(
+            [
+                self.pair_df,
+                pd.DataFrame(matches, columns=patterns, index=self.pair_df.index),
+            ],
+            axis=1,
+        )
 
     def add_death_cross_pattern(self):
         self.pair_df["sma_50_below_sma_200"] = (
@@ -193,8 +282,7 @@ class Indicators:
     def add_greed_and_fear(self):
         if self.datasets.get("greed_and_fear") is None:
             url = "https://api.alternative.me/fng/?limit=0"
-            resp = requests.get(url)
-            resp_json = resp.json()
+            resp_json = get_json(url)
             df = pd.DataFrame(
                 resp_json["data"],
                 columns=[
@@ -239,10 +327,9 @@ class Indicators:
         raise ValueError("Invalid target type")
 
     def add_target(self):
-        self.pair_df["next_open"] = self.pair_df["open"].shift(-1)
-        self.pair_df["next_high"] = self.pair_df["high"].shift(-1)
-        self.pair_df["next_low"] = self.pair_df["low"].shift(-1)
-        self.pair_df["next_close"] = self.pair_df["close"].shift(-1)
+        self.pair_df[["next_open", "next_high", "next_low", "next_close"]] = (
+            self.grouped_shift(self.pair_df, ["open", "high", "low", "close"], -1)
+        )
         self.pair_df.insert(
             0,
             f"hit_{self.target_type}",
@@ -255,7 +342,8 @@ class Indicators:
                 axis=1,
             ),
         )
-        self.pair_df = self.pair_df.iloc[:-1]
+        if not self.keep_unlabelled_rows:
+            self.pair_df = self.pair_df.iloc[:-1]
         self.pair_df.drop(
             columns=["next_open", "next_high", "next_low", "next_close"], inplace=True
         )
@@ -319,8 +407,7 @@ class Indicators:
         )
         if endpoint in ("open-interest-history", "liquidation-history"):
             endpoint += "&convert_to_usd=true"
-        resp = requests.get(url=endpoint, headers={"api_key": coinalyze_key})
-        resp_json = resp.json()
+        resp_json = get_json(endpoint, headers={"api_key": coinalyze_key})
         df = pd.DataFrame(resp_json[0]["history"])
         df = df.rename(columns={"t": "calendar_dt"})
         df["calendar_dt"] = pd.to_datetime(df["calendar_dt"], unit="s").dt.date
@@ -576,7 +663,11 @@ class Indicators:
         self.log.info("Adding trend indicators")
         self.pair_df["sma_50"] = talib.SMA(self.pair_df["close"], timeperiod=50)
         self.pair_df["sma_200"] = talib.SMA(self.pair_df["close"], timeperiod=200)
-        self.pair_df["ema_100"] = talib.EMA(self.pair_df["close"], timeperiod=100)
+        pair = self.pair_df["pair"].iloc[0]
+        if pair in self.ema_100_values:
+            self.pair_df["ema_100"] = self.ema_100_values[pair]
+        else:
+            self.pair_df["ema_100"] = talib.EMA(self.pair_df["close"], timeperiod=100)
         self.add_current_trend()
 
         self.add_sar_signal()
@@ -740,9 +831,10 @@ class Indicators:
         self.add_bollinger_indicators()
 
     def add_obv_indicators(self):
+        pair = self.pair_df["pair"].iloc[0]
         self.pair_df["obv"] = talib.OBV(
             self.pair_df["close"], self.pair_df["usd_volume"]
-        )
+        ) + self.obv_offsets.get(pair, 0.0)
         """Volume-confirmed breakouts with ATR filtering"""
         volatility_window = 14
         # Calculate ATR for volatility adjustment
@@ -924,26 +1016,21 @@ class Indicators:
             - self.pair_df["calendar_dt"]
         ).dt.days
 
+    def get_required_features(self) -> list[str] | None:
+        return self.required_features
+
+    async def add_pair_indicators(self):
+        await FEATURE_REGISTRY.run(self, required=self.get_required_features())
+        if self.pair_df["calendar_dt"].duplicated().any():
+            raise Exception("Duplicates found!")
+        self.pair_df = self.pair_df.astype(self.get_compact_dtypes(self.pair_df))
+
     async def add_indicators(self) -> pd.DataFrame:
         data_with_indicators = pd.DataFrame()
         for pair in self.raw_data["pair"].unique().tolist():
             self.log.info(f"    Adding indicators for {pair}")
             self.pair_df = self.raw_data[self.raw_data["pair"] == pair]
-
-            self.add_target()
-
-            self.add_trend_indicators()
-            self.add_price_indicators()
-            self.add_derivatives_indicators()
-            self.add_momentum_indicators()
-            self.add_volatility_indicators()
-            self.add_volume_indicators()
-            await self.add_market_beta_indicators()
-            self.add_macro_indicators()
-            self.add_seasonality()
-            self.add_patterns()
-            if self.pair_df["calendar_dt"].duplicated().any():
-                raise Exception("Duplicates found!")
+            await self.add_pair_indicators()
             data_with_indicators = pd.concat([data_with_indicators, self.pair_df])
         del self.pair_df
         return data_with_indicators
@@ -0,0 +1,236 @@
+import asyncio
+import os
+import sys
+from datetime import date, datetime as dt, timedelta, timezone
+from typing import Literal
+
+import pandas as pd
+import xgboost as xgb
+from aiohttp import web
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
+
+from services.ai.features import FEATURE_REGISTRY
+from services.ai.incremental import PairBuffer
+from services.ai.model_registry import MODEL_REGISTRY, predict_proba
+from services.ai.pre_process import PreProcessing
+from utils.pools import close_async_clients
+
+
+class PredictionService(PreProcessing):
+    keep_unlabelled_rows: bool = True
+
+    # bars kept per pair: covers the longest rolling window (sma_200) and the
+    # warm-up of the exponential indicators, EMA 100 and OBV are carried over
+    lookback_days: int = 400
+    refresh_interval: int = 60 * 60
+    # buffers of pairs without a new bar for longer are dropped (delisted pairs)
+    max_stale_days: int = 3
+    prediction_backend: Literal["dmatrix", "inplace"] = "inplace"
+
+    pair_buffers: dict[str, PairBuffer]
+    # last date of the pairs whose buffer was dropped for lack of new bars
+    stale_pairs: dict[str, date]
+    # refreshed_at, features and predictions of the last refresh, replaced at once
+    snapshot: dict
+
+    def __init__(
+        self,
+        target_type: Literal["take_profit", "stop_loss"],
+        pairs: list[str] = None,
+    ):
+        super().__init__(is_training=False, target_type=target_type)
+        self.pairs = pairs
+        self.model = None
+        self.pair_buffers = dict()
+        self.stale_pairs = dict()
+        self.snapshot = None
+
+    def load_model(self) -> xgb.Booster:
+        """
+        Cached by the registry, a newly saved model is picked up with the features
+        it expects, and with the pair encodings and scalers fitted by its training
+        """
+        model = MODEL_REGISTRY.load(self.model_name)
+        if model is not self.model:
+            self.model = model
+            # only the features of the saved model are computed
+            self.required_features = self.load_feature_manifest()
+            self.set_pair_encoding_mapping(dict())
+            self.pair_scalers = dict()
+            self.get_pair_encoding_mapping()
+            self.load_pair_scalers()
+        return self.model
+
+    def warm_up(self):
+        """
+        Model, pair encodings and scalers are loaded once and kept in memory, until
+        a new model is saved
+        """
+        self.load_model()
+        warmup = FEATURE_REGISTRY.get_warmup(self, self.get_required_features())
+        if self.lookback_days < warmup:
+            raise ValueError(
+                f"lookback_days ({self.lookback_days}) is shorter than the features "
+                f"warm-up ({warmup} bars)"
+            )
+
+    def get_served_pairs(self) -> list[str]:
+        """Requested pairs, restricted to the ones the scalers were fitted on"""
+        known_pairs = self.load_pair_scalers()["pairs"].tolist()
+        if not self.pairs:
+            return known_pairs
+        return [pair for pair in self.pairs if pair in known_pairs]
+
+    def get_from_dates(self, pairs: list[str]) -> dict[date | None, list[str]]:
+        """
+        Pairs grouped by the first date to read: the day following their buffered
+        bars (or their last bar for stale pairs), their full history (None) when
+        they have no buffer yet
+        """
+        from_dates = dict()
+        for pair in dict.fromkeys(pairs + self.required_pairs):
+            if pair in self.pair_buffers:
+                from_date = self.pair_buffers[pair].last_date + timedelta(days=1)
+            elif pair in self.stale_pairs:
+                from_date = self.stale_pairs[pair] + timedelta(days=1)
+            else:
+                from_date = None
+            from_dates.setdefault(from_date, []).append(pair)
+        return from_dates
+
+    def drop_stale_buffers(self):
+        if not self.pair_buffers:
+            return
+        latest_date = max(buffer.last_date for buffer in self.pair_buffers.values())
+        for pair, buffer in list(self.pair_buffers.items()):
+            if (latest_date - buffer.last_date).days > self.max_stale_days:
+                self.log.warning(
+                    f"No new bar for {pair} since {buffer.last_date}, dropping it"
+                )
+                self.stale_pairs[pair] = buffer.last_date
+                del self.pair_buffers[pair]
+
+    def load_training_dataset(
+        self, pairs: list[str] = None, from_date: date = None
+    ) -> pd.DataFrame:
+        """
+        Only the bars following the buffered ones are read, per pair (the full
+        history of a pair without a buffer, to seed its running state), the
+        indicators are then computed on the buffered bars
+        """
+        pairs = pairs if pairs else self.get_served_pairs()
+        new_bars = pd.concat(
+            [
+                super(PredictionService, self).load_training_dataset(
+                    pairs=pairs_to_read, from_date=from_date
+                )
+                for from_date, pairs_to_read in self.get_from_dates(pairs).items()
+            ]
+        )
+        # the required pairs are read with every group
+        new_bars = new_bars.drop_duplicates(subset=["pair", "calendar_dt"])
+        new_bars = new_bars.sort_values(by="calendar_dt", kind="stable")
+        for pair, bars in new_bars.groupby("pair", sort=False):
+            if pair in self.stale_pairs:
+                # its running state is seeded again from the full history
+                self.log.info(f"New bars for {pair}, reloading it on next refresh")
+                del self.stale_pairs[pair]
+                continue
+            if pair not in self.pair_buffers:
+                self.pair_buffers[pair] = PairBuffer(max_bars=self.lookback_days)
+            self.pair_buffers[pair].append(bars)
+        self.drop_stale_buffers()
+        self.obv_offsets = dict()
+        self.ema_100_values = dict()
+        for pair, buffer in self.pair_buffers.items():
+            self.obv_offsets[pair] = buffer.obv_offset
+            self.ema_100_values[pair] = buffer.ema_100_values
+        df = pd.concat([buffer.bars for buffer in self.pair_buffers.values()])
+        return df.sort_values(by="calendar_dt", kind="stable", ignore_index=True)
+
+    async def compute_latest_features(self) -> pd.DataFrame:
+        """Features of the latest day of every pair, computed on the buffered bars"""
+        # external datasets are cached per run, they must include the new days
+        self.datasets = dict()
+        df = await self.pre_process_data(pairs=self.get_served_pairs())
+        return df.groupby("pair", observed=True).tail(1)
+
+    def predict_latest(self, features: pd.DataFrame) -> pd.DataFrame:
+        """A single batched prediction over all the pairs"""
+        x = features[self.model.feature_names]
+        return pd.DataFrame(
+            dict(
+                calendar_dt=features["calendar_dt"].astype(str).to_numpy(),
+                prediction=predict_proba(self.model, x, self.prediction_backend),
+            ),
+            index=pd.Index(features["pair"].astype(str), name="pair"),
+        )
+
+    async def refresh(self):
+        """
+        Runs on the service's event loop, the blocking and CPU bound steps in worker
+        threads. Requests keep being served from the previous snapshot, which is
+        replaced in a single assignment once the new predictions are ready.
+        """
+        self.log.info("Refreshing predictions")
+        await asyncio.to_thread(self.load_model)
+        features = await self.compute_latest_features()
+        predictions = await asyncio.to_thread(self.predict_latest, features)
+        self.snapshot = dict(
+            refreshed_at=dt.now(tz=timezone.utc),
+            features=features,
+            predictions=predictions,
+        )
+        self.log.info(f"Predictions refreshed for {len(predictions)} pairs")
+
+    async def run_refresh_loop(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                self.log.warning(f"Could not refresh predictions:\n{e}")
+            await asyncio.sleep(self.refresh_interval)
+
+    def get_predictions(self, pairs: list[str]) -> dict:
+        # a single read, the refresh may replace the snapshot meanwhile
+        snapshot = self.snapshot
+        if snapshot is None:
+            raise web.HTTPServiceUnavailable(text="Predictions are not ready yet")
+        predictions = snapshot["predictions"]
+        unknown_pairs = [pair for pair in pairs if pair not in predictions.index]
+        if unknown_pairs:
+            raise web.HTTPNotFound(text=f"No predictions for {unknown_pairs}")
+        if pairs:
+            predictions = predictions.loc[pairs]
+        return dict(
+            refreshed_at=snapshot["refreshed_at"].isoformat(),
+            predictions=predictions.reset_index().to_dict(orient="records"),
+        )
+
+    async def handle_predict(self, request: web.Request) -> web.Response:
+        """GET /predict?pairs=BTC/USD,ETH/USD, all the served pairs by default"""
+        pairs = [pair for pair in request.query.get("pairs", "").split(",") if pair]
+        return web.json_response(self.get_predictions(pairs))
+
+
+async def run_prediction_service(
+    host: str = "localhost", port: int = 8796, pairs: list[str] = None
+):
+    service = PredictionService(target_type="take_profit", pairs=pairs)
+    service.warm_up()
+    app = web.Application()
+    app.router.add_get("/predict", service.handle_predict)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+        service.log.info(f"Prediction service listening on {host}:{port}")
+        await service.run_refresh_loop()
+    finally:
+        await runner.cleanup()
+        await close_async_clients()
+
+
+if __name__ == "__main__":
+    asyncio.run(run_prediction_service())
@@ -0,0 +1,143 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from datetime import datetime as dt
+from pathlib import Path
+from typing import Literal
+
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+from xgboost import XGBClassifier
+
+from utils.helpers import (
+    get_logger,
+    get_s3_etag,
+    load_from_s3,
+    upload_to_s3,
+    write_file_to_s3,
+)
+
+
+class ModelRegistry:
+    """
+    Models saved in xgboost's native UBJSON format, with a metadata file holding
+    their sha256. Loaded boosters are kept in an LRU cache and only downloaded
+    again when the S3 ETag of the model file changes.
+    """
+
+    assets_path: Path = Path("./services/ai/assets")
+
+    def __init__(self, max_cached_models: int = 4):
+        self.max_cached_models = max_cached_models
+        # model name -> (S3 ETag it was loaded from, booster)
+        self.models: OrderedDict[str, tuple[str, xgb.Booster]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.log = get_logger("model-registry")
+
+    def get_model_path(self, model_name: str) -> Path:
+        return self.assets_path / f"{model_name}.ubj"
+
+    def get_metadata_path(self, model_name: str) -> Path:
+        return self.assets_path / f"{model_name}_model.json"
+
+    @staticmethod
+    def get_sha256(path: Path) -> str:
+        return hashlib.sha256(path.read_bytes()).hexdigest()
+
+    @staticmethod
+    def get_md5(path: Path) -> str:
+        """S3 ETag of a file uploaded in a single part"""
+        return hashlib.md5(path.read_bytes()).hexdigest()
+
+    def save(self, model: XGBClassifier, model_name: str, metadata: dict) -> dict:
+        model_path = self.get_model_path(model_name)
+        model.get_booster().save_model(model_path)
+        metadata = dict(
+            metadata,
+            model_name=model_name,
+            saved_on=dt.now().isoformat(),
+            xgboost_version=xgb.__version__,
+            feature_names=model.get_booster().feature_names,
+            sha256=self.get_sha256(model_path),
+        )
+        write_file_to_s3(
+            self.get_metadata_path(model_name), json.dumps(metadata, indent=2)
+        )
+        # uploaded last: a new model ETag means its metadata is already available
+        upload_to_s3(model_path)
+        with self.lock:
+            self.models.pop(model_name, None)
+        return metadata
+
+    def load_metadata(self, model_name: str) -> dict:
+        with open(self.get_metadata_path(model_name)) as f:
+            return json.load(f)
+
+    def download(self, model_name: str, etag: str | None):
+        """
+        Model and metadata files, unless the local model matches the remote one or
+        there is no remote one to compare with (etag is None)
+        """
+        model_path = self.get_model_path(model_name)
+        if (
+            model_path.is_file()
+            and self.get_metadata_path(model_name).is_file()
+            and (etag is None or etag.strip('"') == self.get_md5(model_path))
+        ):
+            return
+        self.log.info(f"Downloading model {model_name}")
+        load_from_s3(self.get_metadata_path(model_name).name)
+        load_from_s3(model_path.name)
+
+    def load(self, model_name: str) -> xgb.Booster:
+        """
+        Cached model, reloaded when its S3 ETag changed. When S3 can't be reached,
+        the cached or local model is used.
+        """
+        etag = get_s3_etag(self.get_model_path(model_name).name)
+        with self.lock:
+            if model_name in self.models:
+                cached_etag, model = self.models[model_name]
+                if etag is None or etag == cached_etag:
+                    self.models.move_to_end(model_name)
+                    return model
+            self.download(model_name, etag)
+            model_path = self.get_model_path(model_name)
+            if not model_path.is_file():
+                raise FileNotFoundError(f"No model saved under {model_name}")
+            if self.load_metadata(model_name)["sha256"] != self.get_sha256(model_path):
+                raise ValueError(f"Model {model_name} does not match its sha256")
+            model = xgb.Booster(model_file=model_path)
+            self.models[model_name] = (etag, model)
+            self.models.move_to_end(model_name)
+            if len(self.models) > self.max_cached_models:
+                self.models.popitem(last=False)
+            return model
+
+
+def predict_proba(
+    booster: xgb.Booster,
+    x: pd.DataFrame,
+    backend: Literal["dmatrix", "inplace"] = "dmatrix",
+) -> np.ndarray:
+    """
+    Positive class probability, up to the best iteration when early stopped. The
+    inplace backend skips the DMatrix construction: the features are put in the
+    booster's order and predicted from a contiguous float32 array.
+    """
+    iteration_range = (0, 0)
+    if "best_iteration" in booster.attributes():
+        iteration_range = (0, booster.best_iteration + 1)
+    if backend == "dmatrix":
+        return booster.predict(xgb.DMatrix(x), iteration_range=iteration_range)
+    if backend == "inplace":
+        x = np.ascontiguousarray(x[booster.feature_names].to_numpy(dtype=np.float32))
+        return booster.inplace_predict(
+            x, iteration_range=iteration_range, validate_features=False
+        )
+    raise ValueError(f"Unknown prediction backend: {backend}")
+
+
+MODEL_REGISTRY = ModelRegistry()
@@ -1,20 +1,66 @@
+import asyncio
 import json
 import os
+from datetime import date
 from pathlib import Path
 from typing import Literal
 
-import joblib
 import numpy as np
 import pandas as pd
-from sklearn.preprocessing import StandardScaler
 
 from services.ai.raw_training_data import TrainingDataset
-from utils.helpers import write_file_to_s3, load_from_s3
+from utils.helpers import write_file_to_s3, load_from_s3, upload_to_s3
 
 
 class PreProcessing(TrainingDataset):
     assets_path: Path = Path("./services/ai/assets")
+    model_name: str = "next_day_price_direction"
     pre_processed_df: pd.DataFrame
+    pair_encoding: dict[str, float]
+    encoded_pairs: dict[float, list[str]]
+    pair_scalers: dict[str, np.ndarray]
+
+    standardized_columns: list[str] = [
+        "distance_to_atl",
+        "distance_to_ath",
+        "btc_usd_open_interest",
+        "qrt_liquidity",
+        "nfp_actual",
+        "nfp_forecast",
+        "nfp_previous",
+        "longs_liquidations",
+        "shorts_liquidations",
+    ]
+    # used as exact lookup keys or in P&L computations
+    float64_columns: list[str] = [
+        "pair_encoded",
+        "day_peak",
+        "day_drawdown",
+        "day_return",
+    ]
+    # indicator columns the pre-processing steps read, always computed
+    required_columns: list[str] = [
+        "usd_volume",
+        "sma_50",
+        "sma_200",
+        "ema_100",
+        "volume_sma_50",
+        "rsi",
+        "greed_and_fear_index",
+        "vix",
+        "historical_volatility",
+        "btc_usd_open_interest",
+        "nfp_actual",
+        "nfp_forecast",
+        "nfp_previous",
+        "longs_liquidations",
+        "shorts_liquidations",
+        "days_to_next_nfp",
+        "days_to_next_fed_decisions",
+        "day_of_week",
+        "month_of_year",
+        "days_to_quarter_end",
+    ]
 
     def __init__(
         self,
@@ -25,6 +71,29 @@ class PreProcessing(TrainingDataset):
         self.is_training = is_training
         os.makedirs(self.assets_path, exist_ok=True)
         self.encoded_pairs_path = f"{self.assets_path}/pair_encode.json"
+        self.scalers_path = f"{self.assets_path}/pair_scalers.npz"
+        self.feature_manifest_path = (
+            f"{self.assets_path}/{self.model_name}_features.json"
+        )
+        self.pair_encoding = dict()
+        self.encoded_pairs = dict()
+        self.pair_scalers = dict()
+
+    def get_required_features(self) -> list[str] | None:
+        if self.required_features is None:
+            return None
+        return self.required_features + self.required_columns
+
+    def load_feature_manifest(self) -> list[str] | None:
+        """
+        Features the saved model expects, written with it by Train, None for a model
+        saved without a manifest
+        """
+        load_from_s3(Path(self.feature_manifest_path).name)
+        if not Path(self.feature_manifest_path).is_file():
+            return None
+        with open(self.feature_manifest_path) as f:
+            return json.load(f)["features"]
 
     def remove_non_used_columns(self):
         self.pre_processed_df.drop(
@@ -58,10 +127,18 @@ class PreProcessing(TrainingDataset):
         self.to_pct(columns=["rsi", "greed_and_fear_index", "vix"])
         self.pre_processed_df.drop(columns=distance_to_close_metrics, inplace=True)
 
-    def get_pair_encoding_mapping(self) -> dict:
-        load_from_s3("pair_encode.json")
-        with open(self.encoded_pairs_path) as f:
-            return json.loads(f.read())
+    def set_pair_encoding_mapping(self, mapping: dict[str, float]):
+        self.pair_encoding = mapping
+        self.encoded_pairs = dict()
+        for pair, encoding in mapping.items():
+            self.encoded_pairs.setdefault(encoding, []).append(pair)
+
+    def get_pair_encoding_mapping(self) -> dict[str, float]:
+        if not self.pair_encoding:
+            load_from_s3("pair_encode.json")
+            with open(self.encoded_pairs_path) as f:
+                self.set_pair_encoding_mapping(json.loads(f.read()))
+        return self.pair_encoding
 
     def encode_pairs(self):
         """
@@ -78,6 +155,7 @@ class PreProcessing(TrainingDataset):
                 "day_return"
             ].mean()
             write_file_to_s3(self.encoded_pairs_path, pair_target_means.to_json())
+            self.set_pair_encoding_mapping(pair_target_means.to_dict())
         else:
             pair_target_means = self.get_pair_encoding_mapping()
         self.pre_processed_df["pair_encoded"] = self.pre_processed_df["pair"].map(
@@ -85,60 +163,93 @@ class PreProcessing(TrainingDataset):
         )
 
     def encoded_pair_to_pair(self, encoded_pair: float) -> str:
-        mapping = self.get_pair_encoding_mapping()
-        for p, encoding in mapping.items():
-            if round(encoding, 4) == round(encoded_pair, 4):
-                return p
-        raise ValueError("Unknown pair")
-
-    def standardize_with_cache(
-        self, pair_df: pd.DataFrame, cols: list[str], standardizer_name: str
-    ) -> pd.DataFrame:
-        scalers_path = f"{self.assets_path}/scalers"
-        os.makedirs(scalers_path, exist_ok=True)
-        standardizer_path = f"{scalers_path}/{standardizer_name}.gz"
-        if self.is_training:
-            scaler = StandardScaler()
-            scaler.fit(pair_df[cols])
-            write_file_to_s3(standardizer_path, scaler, is_pickle=True)
-        else:
-            load_from_s3(f"{standardizer_name}.gz")
-            scaler = joblib.load(standardizer_path)
-        pair_df[cols] = scaler.transform(pair_df[cols])
-        return pair_df
+        self.get_pair_encoding_mapping()
+        pairs = self.encoded_pairs.get(encoded_pair)
+        if not pairs:
+            raise ValueError("Unknown pair")
+        if len(pairs) > 1:
+            raise ValueError(f"Ambiguous pair encoding, shared by {pairs}")
+        return pairs[0]
 
-    def standardize_values(self):
-        full_df = pd.DataFrame()
-        cols = [
-            "distance_to_atl",
-            "distance_to_ath",
-            "btc_usd_open_interest",
-            "qrt_liquidity",
-        ]
-        nfp_cols = [
-            "nfp_actual",
-            "nfp_forecast",
-            "nfp_previous",
-        ]
-        liquidation_cols = ["longs_liquidations", "shorts_liquidations"]
-        for encoded_pair in self.pre_processed_df["pair_encoded"].unique().tolist():
-            pair_df = self.pre_processed_df[
-                self.pre_processed_df["pair_encoded"] == encoded_pair
-            ]
-            pair = self.encoded_pair_to_pair(encoded_pair).replace("/", "-")
-            for col in cols:
-                pair_df = self.standardize_with_cache(
-                    pair_df, [col], f"{pair}_{col}_standard_scaler"
+    def fit_pair_scalers(self) -> dict[str, np.ndarray]:
+        """Per-pair mean and scale, equivalent to one StandardScaler per pair and column"""
+        grouped = self.pre_processed_df.groupby("pair")[self.standardized_columns]
+        mean = grouped.mean()
+        scale = grouped.std(ddof=0)
+        # same handling of constant features as StandardScaler
+        scale = scale.mask(scale < 10 * np.finfo(np.float64).eps, 1.0)
+        return dict(
+            pairs=mean.index.to_numpy(dtype=str),
+            columns=np.array(self.standardized_columns),
+            mean=mean.to_numpy(dtype=np.float64),
+            scale=scale.to_numpy(dtype=np.float64),
+        )
+
+    def read_pair_scalers(self) -> dict[str, np.ndarray]:
+        load_from_s3(Path(self.scalers_path).name)
+        with np.load(self.scalers_path) as artifact:
+            return {key: artifact[key] for key in artifact.files}
+
+    def merge_pair_scalers(
+        self, scalers: dict[str, np.ndarray]
+    ) -> dict[str, np.ndarray]:
+        """
+        Stored scalers of the pairs that were not refitted (a run on a subset of the
+        pairs) are kept, the refitted pairs' rows are replaced
+        """
+        try:
+            stored = self.read_pair_scalers()
+        except FileNotFoundError:
+            return scalers
+        if stored["columns"].tolist() != self.standardized_columns:
+            self.log.warning("Stored scalers were fitted on other columns, replacing")
+            return scalers
+        kept = ~np.isin(stored["pairs"], scalers["pairs"])
+        return dict(
+            pairs=np.concatenate([stored["pairs"][kept], scalers["pairs"]]),
+            columns=scalers["columns"],
+            mean=np.concatenate([stored["mean"][kept], scalers["mean"]]),
+            scale=np.concatenate([stored["scale"][kept], scalers["scale"]]),
+        )
+
+    def save_pair_scalers(self, scalers: dict[str, np.ndarray]):
+        scalers = self.merge_pair_scalers(scalers)
+        np.savez(self.scalers_path, **scalers)
+        upload_to_s3(self.scalers_path)
+        self.pair_scalers = scalers
+
+    def load_pair_scalers(self) -> dict[str, np.ndarray]:
+        if not self.pair_scalers:
+            scalers = self.read_pair_scalers()
+            if scalers["columns"].tolist() != self.standardized_columns:
+                raise ValueError(
+                    "Stored scalers do not match the standardized columns"
                 )
-            pair_df = self.standardize_with_cache(
-                pair_df, nfp_cols, f"{pair}_nfp_standard_scaler"
-            )
-            pair_df = self.standardize_with_cache(
-                pair_df, liquidation_cols, f"{pair}_liquidation_standard_scaler"
-            )
-            full_df = pd.concat([full_df, pair_df])
-        self.pre_processed_df = full_df.sort_values(by="calendar_dt").reset_index(
-            drop=True
+            self.pair_scalers = scalers
+        return self.pair_scalers
+
+    def standardize_values(self):
+        if self.is_training:
+            scalers = self.fit_pair_scalers()
+            self.save_pair_scalers(scalers)
+        else:
+            scalers = self.load_pair_scalers()
+        cols = self.standardized_columns
+        pair_codes = pd.Index(scalers["pairs"]).get_indexer(
+            self.pre_processed_df["pair"]
+        )
+        if (pair_codes == -1).any():
+            unknown_pairs = self.pre_processed_df.loc[pair_codes == -1, "pair"]
+            raise ValueError(f"No stored scalers for {unknown_pairs.unique().tolist()}")
+        # each row picks its pair's statistics by index
+        values = self.pre_processed_df[cols].to_numpy(dtype=np.float64)
+        mean = scalers["mean"][pair_codes]
+        scale = scalers["scale"][pair_codes]
+        self.pre_processed_df[cols] = (values - mean) / scale
+        # rows come out of add_indicators grouped by pair, the splits and backtests
+        # expect them in date order
+        self.pre_processed_df = self.pre_processed_df.sort_values(
+            by="calendar_dt", kind="stable", ignore_index=True
         )
 
     def countdowns_with_decay(self):
@@ -245,7 +356,7 @@ class PreProcessing(TrainingDataset):
         # 1. Non-linear transformation
         # 1. Non-linear transformation
         self.pre_processed_df["qrt_end_log"] = np.log1p(
-            self.pre_processed_df.days_to_quarter_end
+            self.pre_processed_df.days_to_quarter_end.astype(np.float64)
         )
 
         # 2. Pressure zones
@@ -278,20 +389,60 @@ class PreProcessing(TrainingDataset):
         )
 
     def encoding(self):
-        self.pre_processed_df.replace({False: 0, True: 1}, inplace=True)
+        bool_cols = self.pre_processed_df.select_dtypes(include="bool").columns
+        self.pre_processed_df[bool_cols] = self.pre_processed_df[bool_cols].astype(
+            np.int8
+        )
         self.encode_pairs()
         self.encode_time_features()
 
-    async def pre_process_data(self, pairs: list[str]) -> pd.DataFrame:
-        self.raw_data = self.load_training_dataset(pairs=pairs)
-        self.pre_processed_df = await self.add_indicators()
+    def optimize_dtypes(self):
+        """
+        - Pattern, signal and flag columns: int8 (int16 for patterns reaching ±200)
+        - Continuous features: float32, the precision xgboost trains on, except the
+          float64_columns
+        - Pair: category
+        """
+        dtypes = self.get_compact_dtypes(
+            self.pre_processed_df,
+            with_floats=True,
+            float64_columns=self.float64_columns,
+            # every pre-processed column is a model input, read as float32
+            float32_columns=self.pre_processed_df.columns.tolist(),
+        )
+        dtypes["pair"] = "category"
+        self.pre_processed_df = self.pre_processed_df.astype(dtypes)
+
+    def log_memory_usage(self, stage: str):
+        memory = self.pre_processed_df.memory_usage(deep=True).sum() / 1024**2
+        self.log.info(f"    Memory usage after {stage}: {memory:,.1f} MB")
+
+    def pre_process_indicators(self):
         self.log.info("Pre-processing data")
         self.encoding()
+        self.log_memory_usage("encoding")
         self.handle_absolute_values()
         self.standardize_values()
         self.remove_non_used_columns()
+        self.log_memory_usage("standardization")
+        self.optimize_dtypes()
+        self.log_memory_usage("dtypes optimization")
         # self.pre_processed_df.replace([np.inf, -np.inf], np.nan, inplace=True)
         self.log.info("Pre-processing ended")
+
+    async def pre_process_data(
+        self, pairs: list[str], from_date: date = None
+    ) -> pd.DataFrame:
+        """
+        The database read and the CPU bound steps run in worker threads, so that the
+        caller's event loop (the prediction service's) keeps serving meanwhile
+        """
+        self.raw_data = await asyncio.to_thread(
+            self.load_training_dataset, pairs=pairs, from_date=from_date
+        )
+        self.pre_processed_df = await self.add_indicators()
+        self.log_memory_usage("indicators")
+        await asyncio.to_thread(self.pre_process_indicators)
         if pairs:
             self.pre_processed_df = self.pre_processed_df[
                 self.pre_processed_df["pair"].isin(pairs)
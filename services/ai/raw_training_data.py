@@ -1,11 +1,12 @@
 import asyncio
+import functools
 import os
 import sys
 import warnings
+from datetime import date
 from typing import Literal
 
 import pandas as pd
-import requests
 from ccxt import BadSymbol
 from dotenv import load_dotenv
 from sqlalchemy import sql
@@ -14,7 +15,7 @@ from sqlalchemy.exc import ProgrammingError
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
 
 from services.ai.indicators import Indicators
-from utils import helpers
+from utils import helpers, pools
 
 load_dotenv(helpers.ENV_PATH, verbose=True)
 warnings.filterwarnings("ignore")
@@ -28,6 +29,8 @@ class TrainingDataset(Indicators):
     formatted_data_view: str = "formatted_data"
 
     exchanges: list[str] = ["binance", "coinbase"]
+    # always loaded with the requested pairs, the market indicators read them
+    required_pairs: list[str] = ["BTC/USD", "ETH/USD"]
 
     def __init__(
         self,
@@ -36,14 +39,17 @@ class TrainingDataset(Indicators):
     ):
         super().__init__(target_type=target_type)
         self.force_refresh = force_refresh
-        self.pre_stored_pairs = self.get_pre_stored_pairs()
 
     @staticmethod
     def call_coinmarket_cap(endpoint: str) -> dict:
         endpoint = f"https://pro-api.coinmarketcap.com/v1/cryptocurrency/{endpoint}"
         headers = {"X-CMC_PRO_API_KEY": os.environ.get("COIN_MARKET_CAP_API_KEY")}
-        resp = requests.get(url=endpoint, headers=headers)
-        return resp.json()["data"]
+        return pools.get_json(endpoint, headers=headers)["data"]
+
+    @functools.cached_property
+    def pre_stored_pairs(self) -> list[str]:
+        """Queried on first use, most pipeline objects never need it"""
+        return self.get_pre_stored_pairs()
 
     def get_pre_stored_pairs(self) -> list[str]:
         query = f"select distinct pair_formatted from training_data.{self.ohlcv_table}"
@@ -74,8 +80,7 @@ class TrainingDataset(Indicators):
         pairs = dict()
         stable_coins = self.get_stable_coins()
         for exchange in self.exchanges:
-            exchange_object = helpers.get_exchange_object(exchange, async_mode=False)
-            exchange_pairs = exchange_object.load_markets()
+            exchange_pairs = pools.get_exchange(exchange).markets
             for pair, pair_details in exchange_pairs.items():
                 base = pair_details["base"]
                 quote = pair_details["quote"]
@@ -91,23 +96,20 @@ class TrainingDataset(Indicators):
         self.log.info(f"{len(pairs)} available pairs")
         return pairs
 
-    def get_pair_ohlcv(self, asset: str):
+    async def get_pair_ohlcv(self, asset: str):
         """Get largest OHLCV for a given asset across various pairs (USD, USDC, USDT) and exchange"""
         self.pair_df = pd.DataFrame()
         final_pair = ""
         final_exchange = ""
         for exchange in self.exchanges:
             pairs = self.available_pairs[asset]
+            exchange_object = await pools.a_get_exchange(exchange)
             for pair in pairs:
                 try:
-                    exchange_object = helpers.get_exchange_object(
-                        exchange, async_mode=False
-                    )
-                    ohlcv_data = helpers.get_ohlcv_history(
+                    ohlcv_data = await helpers.a_get_ohlcv_history(
                         pair=pair,
                         exchange=exchange_object,
                         timeframe="1d",
-                        full_history=True,
                     )
                     self.log.info(f"    Checking {exchange}: {pair}")
                     df = pd.DataFrame(
@@ -165,17 +167,23 @@ class TrainingDataset(Indicators):
             return True
         return False
 
-    def load_training_dataset(self, pairs: list[str] = None) -> pd.DataFrame:
+    def load_training_dataset(
+        self, pairs: list[str] = None, from_date: date = None
+    ) -> pd.DataFrame:
         self.log.info("Loading training data")
         query = f"select * from training_data.{self.formatted_data_view}"
+        conditions = []
         if pairs:
             pairs_to_fetch = pairs.copy()
-            required_pairs = ["BTC/USD", "ETH/USD"]
-            for pair in required_pairs:
+            for pair in self.required_pairs:
                 if pair not in pairs:
                     pairs_to_fetch.append(pair)
             pairs_str = "','".join(pairs_to_fetch)
-            query += f" where pair in ('{pairs_str}')"
+            conditions.append(f"pair in ('{pairs_str}')")
+        if from_date:
+            conditions.append(f"calendar_dt >= '{from_date}'")
+        if conditions:
+            query += f" where {' and '.join(conditions)}"
         query += " order by calendar_dt"
         df = pd.read_sql_query(sql=query, con=self.db)
         self.log.info(f"Retrieved {len(df)} rows")
@@ -183,18 +191,22 @@ class TrainingDataset(Indicators):
 
     async def get_raw_training_dataset(self):
         self.available_pairs = self.get_available_pairs()
-        for asset in self.available_pairs:
-            pair = f"{asset}/USD"
-            if self.should_get_data(pair):
-                self.log.info(f"Processing {pair}")
-                self.get_pair_ohlcv(asset)
-                if len(self.pair_df) < self.min_data_amt:
-                    self.log.warning(
-                        f"    Skipping {pair}, available data: {len(self.pair_df)} days"
-                    )
-                else:
-                    self.update_table(table_name=self.ohlcv_table)
-                    self.compute_key_levels()
+        try:
+            for asset in self.available_pairs:
+                pair = f"{asset}/USD"
+                if self.should_get_data(pair):
+                    self.log.info(f"Processing {pair}")
+                    await self.get_pair_ohlcv(asset)
+                    if len(self.pair_df) < self.min_data_amt:
+                        self.log.warning(
+                            f"    Skipping {pair}, available data: "
+                            f"{len(self.pair_df)} days"
+                        )
+                    else:
+                        self.update_table(table_name=self.ohlcv_table)
+                        self.compute_key_levels()
+        finally:
+            await pools.close_async_clients()
 
 
 if __name__ == "__main__":
@@ -2,6 +2,8 @@ import asyncio
 import json
 import os
 import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime as dt
 from pathlib import Path
 from typing import Literal
@@ -11,22 +13,77 @@ import optuna
 import pandas as pd
 import xgboost as xgb
 from sklearn.metrics import roc_auc_score, classification_report
-from sklearn.model_selection import TimeSeriesSplit
+from optuna.storages.journal import JournalFileBackend
+from optuna.trial import TrialState
 from xgboost import XGBClassifier
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
 
+from services.ai.model_registry import MODEL_REGISTRY
 from services.ai.pre_process import PreProcessing
 from utils.helpers import write_file_to_s3, load_from_s3
 
 
+class OptunaPruningCallback(xgb.callback.TrainingCallback):
+    """Reports the validation AUC of every boosting round so optuna can prune"""
+
+    def __init__(self, trial: optuna.Trial, data_name: str = "validation"):
+        self.trial = trial
+        self.data_name = data_name
+
+    def after_iteration(self, model, epoch: int, evals_log: dict) -> bool:
+        self.trial.report(evals_log[self.data_name]["auc"][-1], step=epoch)
+        if self.trial.should_prune():
+            raise optuna.TrialPruned(f"Pruned at boosting round {epoch}")
+        return False
+
+
+def fit_walk_forward_window(
+    features_path: str,
+    target_path: str,
+    params: dict,
+    train_rows: slice,
+    stopping_rows: slice,
+    test_rows: slice,
+) -> np.ndarray:
+    """
+    Trains one walk-forward window on row slices of the memory-mapped feature
+    matrix and returns its out-of-sample predictions (top level so that worker
+    processes can unpickle it)
+    """
+    x = np.load(features_path, mmap_mode="r")
+    y = np.load(target_path, mmap_mode="r")
+    model = xgb.XGBClassifier(**params)
+    model.fit(
+        x[train_rows],
+        y[train_rows],
+        eval_set=[(x[stopping_rows], y[stopping_rows])],
+        verbose=False,
+    )
+    return model.predict_proba(x[test_rows])[:, 1]
+
+
 class TrainingOptimization(PreProcessing):
     model_base_params: dict
 
     datasets: dict
+    dates: np.ndarray
+    unique_dates: np.ndarray
+    training_columns: dict[str, list[str]]
+    quantile_dmatrices: dict[int, tuple[xgb.QuantileDMatrix, xgb.QuantileDMatrix]]
+
+    trial_n_jobs: int = -1
+    # features the model is restricted to, all the pre-processed ones when None
+    selected_features: list[str] = None
 
     starting_balance: int = 1000
-    balance: int
+    backtest_columns: list[str] = [
+        "pair",
+        "calendar_dt",
+        "day_drawdown",
+        "day_peak",
+        "day_return",
+    ]
 
     def __init__(
         self,
@@ -34,18 +91,68 @@ class TrainingOptimization(PreProcessing):
     ):
         super().__init__(is_training=True, target_type=target_type)
         self.best_params_path = f"{self.assets_path}/best_hyperparameters.json"
+        self.training_columns = dict()
+        self.quantile_dmatrices = dict()
+        self.quantile_dmatrices_lock = threading.Lock()
+
+    def sort_by_date(self):
+        """
+        Date arrays of the pre-processed rows, which standardize_values already puts
+        in date order (re-sorted stably in case they were filtered or concatenated),
+        so that every split is a row range
+        """
+        self.pre_processed_df = self.pre_processed_df.sort_values(
+            by="calendar_dt", kind="stable", ignore_index=True
+        )
+        self.dates = self.pre_processed_df["calendar_dt"].to_numpy(
+            dtype="datetime64[ns]"
+        )
+        self.unique_dates = np.unique(self.dates)
+
+    def get_date_boundaries(self, date_positions: list[int]) -> np.ndarray:
+        """
+        First row of each date position (index in the unique dates) in the date
+        sorted data, the number of rows for positions past the last date
+        """
+        date_positions = np.asarray(date_positions)
+        in_range = date_positions < len(self.unique_dates)
+        cutoffs = self.unique_dates[np.where(in_range, date_positions, 0)]
+        return np.where(in_range, np.searchsorted(self.dates, cutoffs), len(self.dates))
+
+    def freeze_training_columns(self):
+        """Schema of the pre-processed data, computed once and reused by every trial"""
+        target_col = f"hit_{self.target_type}"
+        cols_to_remove = ["pair", "calendar_dt", target_col]
+        self.training_columns = dict(
+            features=[
+                col
+                for col in self.pre_processed_df.columns
+                if col not in cols_to_remove
+                and (self.selected_features is None or col in self.selected_features)
+            ],
+            target=[target_col],
+        )
 
     def get_training_columns(
         self, col_type: Literal["features", "target"]
     ) -> list[str]:
-        target_col = f"hit_{self.target_type}"
-        if col_type == "target":
-            return [target_col]
-        df = self.pre_processed_df.copy(deep=True)
-        cols_to_remove = ["pair", "calendar_dt"]
-        df.drop(columns=cols_to_remove, inplace=True)
-        cols = df.columns.tolist()
-        return [col for col in cols if col != target_col]
+        if not self.training_columns:
+            self.freeze_training_columns()
+        return list(self.training_columns[col_type])
+
+    def materialize_dataset(self, df: pd.DataFrame) -> dict:
+        """
+        Contiguous float32 feature matrix (xgboost's own precision) and target. Of
+        the other columns, only the ones the backtests read are kept.
+        """
+        features_cols = self.get_training_columns("features")
+        target_col = self.get_training_columns("target")[0]
+        x = np.ascontiguousarray(df[features_cols].to_numpy(dtype=np.float32))
+        return dict(
+            df=df[self.backtest_columns + [target_col]],
+            x=pd.DataFrame(x, columns=features_cols, index=df.index),
+            y=df[target_col],
+        )
 
     def get_datasets(
         self,
@@ -57,75 +164,78 @@ class TrainingOptimization(PreProcessing):
         pd.DataFrame,
         pd.DataFrame,
     ]:
-        target_col = self.get_training_columns("target")[0]
-        features_cols = self.get_training_columns("features")
-        train_x = self.datasets["train"]["df"][features_cols]
-        train_y = self.datasets["train"]["df"][target_col]
-        test_x = self.datasets["test"]["df"][features_cols]
-        test_y = self.datasets["test"]["df"][target_col]
-        val_x = self.datasets["val"]["df"][features_cols]
-        val_y = self.datasets["val"]["df"][target_col]
+        train_x = self.datasets["train"]["x"]
+        train_y = self.datasets["train"]["y"]
+        test_x = self.datasets["test"]["x"]
+        test_y = self.datasets["test"]["y"]
+        val_x = self.datasets["val"]["x"]
+        val_y = self.datasets["val"]["y"]
         return train_x, train_y, val_x, val_y, test_x, test_y
 
-    def reset_balance(self):
-        self.balance = self.starting_balance
-
-    def get_pnl(self, row: pd.Series):
-        row.fillna(False, inplace=True)
-        if row["model_buy"]:
-            if row["day_drawdown"] < self.stop_loss:
-                return self.stop_loss
-            if row["day_peak"] > self.take_profit:
-                return self.take_profit
-            return row["day_return"]
-        return 0
-
-    def update_balance(self, row: pd.Series, weight: float = 1) -> float:
-        trade_usd_pnl = 0
-        if row["model_buy"]:
-            investable_amount = self.balance * weight
-            trade_usd_pnl = (investable_amount * (row["pnl"] + 1)) - investable_amount
-            self.balance += trade_usd_pnl
-        return trade_usd_pnl
+    def get_pnl(self, df: pd.DataFrame) -> np.ndarray:
+        """Trade return per row: stop loss first, then take profit, else day return"""
+        model_buy = df["model_buy"].fillna(False).to_numpy(dtype=bool)
+        day_drawdown = df["day_drawdown"].fillna(0).to_numpy(dtype=np.float64)
+        day_peak = df["day_peak"].fillna(0).to_numpy(dtype=np.float64)
+        day_return = df["day_return"].fillna(0).to_numpy(dtype=np.float64)
+        pnl = np.where(
+            day_drawdown < self.stop_loss,
+            self.stop_loss,
+            np.where(day_peak > self.take_profit, self.take_profit, day_return),
+        )
+        return np.where(model_buy, pnl, 0.0)
+
+    def update_balance(
+        self, pnl: np.ndarray, weight: float | np.ndarray = 1
+    ) -> np.ndarray:
+        """Equity curve when every trade is sized as weight * current balance"""
+        return self.starting_balance * np.cumprod(1 + weight * pnl)
+
+    def simulate_trades(self, df: pd.DataFrame) -> tuple[float, np.ndarray]:
+        """Final P&L and equity curve of trading the rows flagged in model_buy"""
+        equity_curve = self.update_balance(self.get_pnl(df))
+        if not len(equity_curve):
+            return 0.0, equity_curve
+        return float(equity_curve[-1] / self.starting_balance - 1), equity_curve
 
     def backtest(
         self,
         raw_df: pd.DataFrame,
         model: XGBClassifier,
         confidence_threshold: float = 0.5,
+        x: pd.DataFrame = None,
     ) -> float:
-        df = raw_df.copy(deep=True)
-        self.reset_balance()
-        features_col = self.get_training_columns("features")
-        df.insert(
-            0,
-            "prediction",
-            model.predict_proba(df[features_col])[:, 1],
-        )
-        df.insert(
-            0,
-            "model_buy",
-            df["prediction"] > confidence_threshold,
+        if x is None:
+            x = raw_df[self.get_training_columns("features")]
+        return self.backtest_predictions(
+            raw_df, model.predict_proba(x)[:, 1], confidence_threshold
         )
-        df.drop(df.tail(1).index, inplace=True)
-        df.insert(0, "pnl", df.apply(self.get_pnl, axis=1))
-        df.insert(0, "usd_pnl", df.apply(self.update_balance, axis=1))
-        df.insert(0, "cumulative_pnl", df["usd_pnl"].cumsum())
-        return (self.balance / self.starting_balance) - 1
+
+    def backtest_predictions(
+        self,
+        raw_df: pd.DataFrame,
+        predictions: np.ndarray,
+        confidence_threshold: float = 0.5,
+    ) -> float:
+        df = raw_df[["day_drawdown", "day_peak", "day_return"]].iloc[:-1]
+        df = df.assign(model_buy=predictions[:-1] > confidence_threshold)
+        final_pnl, _ = self.simulate_trades(df)
+        return final_pnl
 
     def objective(self, trial):
         params = {
             # Core model parameters
             "objective": "binary:logistic",
             "booster": trial.suggest_categorical("booster", ["gbtree"]),
-            "n_jobs": -1,  # Typically fixed to use all cores
+            "n_jobs": self.trial_n_jobs,  # Fixed per worker to avoid oversubscription
             # Tree architecture parameters
             "max_depth": trial.suggest_int("max_depth", 3, 12),
             "max_leaves": trial.suggest_int("max_leaves", 16, 128),
             "grow_policy": trial.suggest_categorical(
                 "grow_policy", ["depthwise", "lossguide"]
             ),
-            "max_bin": trial.suggest_int("max_bin", 100, 1024),
+            # stepped so that trials share a few cached quantized matrices
+            "max_bin": trial.suggest_int("max_bin", 128, 1024, step=128),
             # Regularization parameters
             "gamma": trial.suggest_float("gamma", 0, 10),
             "reg_alpha": trial.suggest_float("reg_alpha", 1e-3, 100, log=True),
@@ -148,40 +258,145 @@ class TrainingOptimization(PreProcessing):
             "random_state": 42,
             "eval_metric": trial.suggest_categorical("eval_metric", ["auc", "logloss"]),
         }
-        model = xgb.XGBClassifier(**params)
-        train_x, train_y, val_x, val_y, _, _ = self.get_datasets()
-        model.fit(
-            train_x,
-            train_y,
-            eval_set=[(val_x, val_y)],
-            verbose=False,
+        dtrain, dval = self.get_quantile_dmatrices(params["max_bin"])
+        booster_params, num_boost_round, early_stopping_rounds = (
+            self.get_booster_params(params)
+        )
+        # auc is always evaluated for pruning, the trial's metric stays last so that
+        # early stopping still uses it
+        booster_params["eval_metric"] = list(
+            dict.fromkeys(["auc", booster_params["eval_metric"]])
         )
-        return self.backtest(self.datasets["val"]["df"], model)
+        booster = xgb.train(
+            booster_params,
+            dtrain,
+            num_boost_round=num_boost_round,
+            evals=[(dval, "validation")],
+            early_stopping_rounds=early_stopping_rounds,
+            verbose_eval=False,
+            callbacks=[OptunaPruningCallback(trial)],
+        )
+        predictions = booster.predict(
+            dval, iteration_range=(0, booster.best_iteration + 1)
+        )
+        return self.backtest_predictions(self.datasets["val"]["df"], predictions)
+
+    def get_quantile_dmatrices(
+        self, max_bin: int
+    ) -> tuple[xgb.QuantileDMatrix, xgb.QuantileDMatrix]:
+        """Train/validation data quantized once per max_bin and shared by all trials"""
+        with self.quantile_dmatrices_lock:
+            if max_bin not in self.quantile_dmatrices:
+                train_x, train_y, val_x, val_y, _, _ = self.get_datasets()
+                dtrain = xgb.QuantileDMatrix(train_x, train_y, max_bin=max_bin)
+                dval = xgb.QuantileDMatrix(val_x, val_y, max_bin=max_bin, ref=dtrain)
+                self.quantile_dmatrices[max_bin] = (dtrain, dval)
+            return self.quantile_dmatrices[max_bin]
+
+    @staticmethod
+    def get_booster_params(params: dict) -> tuple[dict, int, int]:
+        """Translate XGBClassifier parameters to the native xgb.train API"""
+        booster_params = params.copy()
+        num_boost_round = booster_params.pop("n_estimators")
+        early_stopping_rounds = booster_params.pop("early_stopping_rounds")
+        booster_params["nthread"] = booster_params.pop("n_jobs")
+        booster_params["seed"] = booster_params.pop("random_state")
+        booster_params["tree_method"] = "hist"
+        return booster_params, num_boost_round, early_stopping_rounds
 
-    def hyper_parameter_tuning(self, n_trials: int = 100) -> dict:
+    def get_study_storage(
+        self, storage: str = None, study_name: str = None
+    ) -> optuna.storages.BaseStorage | None:
+        """
+        In memory by default. A study is only persisted, and resumed, when a storage
+        URL (sqlite:///...) or a study_name (stored in a local journal file) is given.
+        """
+        if storage:
+            return optuna.storages.get_storage(storage)
+        if study_name:
+            journal_path = f"{self.assets_path}/optuna_journal.log"
+            return optuna.storages.JournalStorage(JournalFileBackend(journal_path))
+        return None
+
+    @staticmethod
+    def get_pruner(
+        pruner: Literal["median", "successive_halving"],
+    ) -> optuna.pruners.BasePruner:
+        if pruner == "median":
+            return optuna.pruners.MedianPruner(n_startup_trials=5, n_warmup_steps=50)
+        if pruner == "successive_halving":
+            return optuna.pruners.SuccessiveHalvingPruner(min_resource=50)
+        raise ValueError(f"Unknown pruner: {pruner}")
+
+    def hyper_parameter_tuning(
+        self,
+        n_trials: int = 100,
+        n_workers: int = 1,
+        pruner: Literal["median", "successive_halving"] = "median",
+        storage: str = None,
+        study_name: str = None,
+    ) -> dict:
+        """
+        Trials run in n_workers threads (xgboost releases the GIL), each one training
+        with cpu_count / n_workers threads. Every call starts a new study, unless a
+        storage or study_name is given: an interrupted run then resumes where it
+        stopped. Only resume studies run on the same data and features, the trials
+        already finished are not scored again.
+        """
         self.log.info("Hyperparameters fine-tuning...")
-        study = optuna.create_study(direction="maximize")
-        study.optimize(self.objective, n_trials=n_trials)
+        self.trial_n_jobs = max(1, (os.cpu_count() or 1) // n_workers)
+        study_storage = self.get_study_storage(storage, study_name)
+        is_resumable = study_storage is not None
+        if is_resumable:
+            study_name = study_name or f"hit_{self.target_type}_tuning"
+        study = optuna.create_study(
+            study_name=study_name,
+            storage=study_storage,
+            direction="maximize",
+            pruner=self.get_pruner(pruner),
+            load_if_exists=is_resumable,
+        )
+        finished_states = (TrialState.COMPLETE, TrialState.PRUNED)
+        finished_trials = len(study.get_trials(states=finished_states))
+        if finished_trials:
+            self.log.info(
+                f"Resuming study {study.study_name} after {finished_trials} "
+                "finished trials"
+            )
+        study.optimize(
+            self.objective,
+            n_trials=max(0, n_trials - finished_trials),
+            n_jobs=n_workers,
+            callbacks=[
+                optuna.study.MaxTrialsCallback(n_trials, states=finished_states)
+            ],
+        )
         best_params = {**self.model_base_params, **study.best_params}
         write_file_to_s3(self.best_params_path, json.dumps(best_params))
         self.log.info(f"Best parameters:\n{best_params}")
         return best_params
 
-    def time_series_cross_validation(self, best_params: dict):
-        tscv = TimeSeriesSplit(n_splits=5)
+    def time_series_cross_validation(self, best_params: dict, n_splits: int = 5):
+        """Expanding folds over the training dates, each validated on the next dates"""
         cv_scores = []
         self.log.info("Running time-series cross-validation...")
-        train_x, train_y, val_x, val_y, _, _ = self.get_datasets()
+        train_x, train_y, _, _, _, _ = self.get_datasets()
+        n_dates = self.datasets["train"]["dates"].stop
+        fold_size = n_dates // (n_splits + 1)
 
-        for fold, (train_idx, val_idx) in enumerate(tscv.split(train_x)):
+        for fold in range(n_splits):
             self.log.info(f"Fold {fold + 1}")
+            val_start = n_dates - (n_splits - fold) * fold_size
+            train_end, val_end = self.get_date_boundaries(
+                [val_start, val_start + fold_size]
+            )
             x_train_fold, x_val_fold = (
-                train_x.iloc[train_idx],
-                val_x.iloc[val_idx],
+                train_x.iloc[:train_end],
+                train_x.iloc[train_end:val_end],
             )
             y_train_fold, y_val_fold = (
-                train_y.iloc[train_idx],
-                val_y.iloc[val_idx],
+                train_y.iloc[:train_end],
+                train_y.iloc[train_end:val_end],
             )
             model = xgb.XGBClassifier(**best_params)
             model.fit(
@@ -203,7 +418,12 @@ class TrainingOptimization(PreProcessing):
 
 class Train(TrainingOptimization):
     raw_training_data: pd.DataFrame
-    model_name: str = "next_day_price_direction"
+    walk_forward_results: pd.DataFrame
+    feature_importances: pd.DataFrame
+
+    # share of the total gain the selected features must cover
+    importance_coverage: float = 0.95
+    permutation_repeats: int = 5
 
     train_size: float = 0.8
     validate_size: float = 0.1
@@ -214,24 +434,142 @@ class Train(TrainingOptimization):
         target_type: Literal["take_profit", "stop_loss"],
     ):
         super().__init__(target_type=target_type)
-        self.model_path = f"{self.assets_path}/{self.model_name}.pkl"
+        self.feature_importances = None
 
     def split(self):
         # Temporal split (80-10-10)
-        all_dates = self.pre_processed_df["calendar_dt"].unique().tolist()
-        train_size = int(len(all_dates) * self.train_size)
-        val_size = int(len(all_dates) * self.validate_size)
+        self.sort_by_date()
+        n_dates = len(self.unique_dates)
+        train_size = int(n_dates * self.train_size)
+        val_size = int(n_dates * self.validate_size)
+        train_end, val_end = self.get_date_boundaries(
+            [train_size, train_size + val_size]
+        )
         datasets = {
-            "train": {"dates": all_dates[:train_size]},
-            "val": {"dates": all_dates[train_size : train_size + val_size]},
-            "test": {"dates": all_dates[train_size + val_size :]},
+            "train": {
+                "dates": slice(0, train_size),
+                "rows": slice(0, train_end),
+            },
+            "val": {
+                "dates": slice(train_size, train_size + val_size),
+                "rows": slice(train_end, val_end),
+            },
+            "test": {
+                "dates": slice(train_size + val_size, n_dates),
+                "rows": slice(val_end, len(self.dates)),
+            },
         }
+        self.freeze_training_columns()
         for dataset, details in datasets.items():
-            df = self.pre_processed_df[
-                self.pre_processed_df["calendar_dt"].isin(details["dates"])
-            ]
-            datasets[dataset]["df"] = df
+            df = self.pre_processed_df.iloc[details["rows"]]
+            datasets[dataset].update(self.materialize_dataset(df))
         self.datasets = datasets
+        self.quantile_dmatrices = dict()
+
+    def get_walk_forward_windows(
+        self, n_windows: int, window_type: Literal["expanding", "rolling"]
+    ) -> list[dict[str, slice]]:
+        """
+        Row slices of every window over the date sorted data: the first window trains
+        on train_size + validate_size of the dates, the rest is split into n_windows
+        test periods. Rolling windows keep the first window's length, expanding ones
+        start from the first date. The tail validate_size of each training window is
+        held out for early stopping.
+        """
+        n_dates = len(self.unique_dates)
+        first_test = int(n_dates * (self.train_size + self.validate_size))
+        test_starts = np.linspace(first_test, n_dates, n_windows + 1).astype(int)
+        windows = []
+        for start, end in zip(test_starts[:-1], test_starts[1:]):
+            if start == end:
+                continue
+            train_start = 0 if window_type == "expanding" else start - first_test
+            stopping_size = max(1, int((start - train_start) * self.validate_size))
+            rows = self.get_date_boundaries(
+                [train_start, start - stopping_size, start, end]
+            )
+            windows.append(
+                dict(
+                    train_rows=slice(rows[0], rows[1]),
+                    stopping_rows=slice(rows[1], rows[2]),
+                    test_rows=slice(rows[2], rows[3]),
+                )
+            )
+        return windows
+
+    async def walk_forward(
+        self,
+        pairs: list[str] = None,
+        n_windows: int = 5,
+        window_type: Literal["expanding", "rolling"] = "expanding",
+        n_workers: int = None,
+        confidence_threshold: float = 0.5,
+    ) -> float:
+        """
+        Retrains the model on successive windows, predicts the period following each
+        of them and backtests the stitched out-of-sample predictions. Windows are
+        fitted in parallel processes that share one memory-mapped copy of the
+        feature matrix.
+        """
+        await self.pre_process_data(pairs=pairs)
+        self.split()
+        params = self.model_base_params
+        df = self.pre_processed_df
+        dataset = self.materialize_dataset(df)
+        features_path = f"{self.assets_path}/walk_forward_features.npy"
+        target_path = f"{self.assets_path}/walk_forward_target.npy"
+        np.save(features_path, dataset["x"].to_numpy())
+        np.save(target_path, dataset["y"].to_numpy(dtype=np.float32))
+        y = dataset["y"].to_numpy()
+        windows = self.get_walk_forward_windows(n_windows, window_type)
+        n_workers = n_workers or min(len(windows), os.cpu_count() or 1)
+        params["n_jobs"] = max(1, (os.cpu_count() or 1) // n_workers)
+        self.log.info(f"Walk-forward over {len(windows)} {window_type} windows")
+        try:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                futures = []
+                for window in windows:
+                    train_y = y[window["train_rows"]]
+                    window_params = dict(
+                        params,
+                        scale_pos_weight=(train_y == 0).sum() / (train_y == 1).sum(),
+                    )
+                    futures.append(
+                        executor.submit(
+                            fit_walk_forward_window,
+                            features_path,
+                            target_path,
+                            window_params,
+                            **window,
+                        )
+                    )
+                predictions = [future.result() for future in futures]
+        finally:
+            Path(features_path).unlink(missing_ok=True)
+            Path(target_path).unlink(missing_ok=True)
+        results = []
+        for i, (window, window_predictions) in enumerate(zip(windows, predictions)):
+            window_df = df.iloc[window["test_rows"]]
+            roc_auc = roc_auc_score(y[window["test_rows"]], window_predictions)
+            self.log.info(
+                f"Window {i + 1}: {window_df['calendar_dt'].min()} -> "
+                f"{window_df['calendar_dt'].max()}, ROC-AUC {roc_auc:.3f}"
+            )
+            results.append(
+                window_df[
+                    ["pair", "calendar_dt", "day_drawdown", "day_peak", "day_return"]
+                ].assign(window=i + 1, prediction=window_predictions)
+            )
+        # a prediction is traded on the following day of the same pair
+        df = pd.concat(results).sort_values(by=["pair", "calendar_dt"], kind="stable")
+        df = df.reset_index(drop=True)
+        df["prediction"] = self.grouped_shift(df, ["prediction"]).fillna(0)
+        df["model_buy"] = df["prediction"] > confidence_threshold
+        final_pnl, equity_curve = self.simulate_trades(df)
+        df["cumulative_pnl"] = equity_curve - self.starting_balance
+        self.walk_forward_results = df
+        self.log.info(f"Walk-forward final P&L: {final_pnl:,.2%}")
+        return final_pnl
 
     @property
     def model_base_params(self) -> dict:
@@ -279,36 +617,84 @@ class Train(TrainingOptimization):
         }
         return {**base_params, **best_params}
 
+    def get_feature_importances(self, model: xgb.XGBClassifier) -> pd.DataFrame:
+        """
+        Total gain of every feature over the model's splits, and drop of the
+        validation ROC-AUC when the feature is shuffled (one prediction per feature
+        and repeat)
+        """
+        _, _, val_x, val_y, _, _ = self.get_datasets()
+        gain = model.get_booster().get_score(importance_type="total_gain")
+        importances = pd.DataFrame(
+            dict(total_gain=[gain.get(col, 0.0) for col in val_x.columns]),
+            index=pd.Index(val_x.columns, name="feature"),
+        )
+        # columns are shuffled in place in a single copy of the validation matrix
+        x = val_x.to_numpy(copy=True)
+        baseline = roc_auc_score(val_y, model.predict_proba(x)[:, 1])
+        rng = np.random.default_rng(42)
+        auc_drops = np.empty((x.shape[1], self.permutation_repeats))
+        for i in range(x.shape[1]):
+            column = x[:, i].copy()
+            for repeat in range(self.permutation_repeats):
+                x[:, i] = rng.permutation(column)
+                auc_drops[i, repeat] = baseline - roc_auc_score(
+                    val_y, model.predict_proba(x)[:, 1]
+                )
+            x[:, i] = column
+        importances["permutation_mean"] = auc_drops.mean(axis=1)
+        importances["permutation_std"] = auc_drops.std(axis=1)
+        return importances.sort_values(by="total_gain", ascending=False)
+
+    def select_features(self, importances: pd.DataFrame) -> list[str]:
+        """
+        Features covering importance_coverage of the total gain, without the ones
+        whose shuffling does not lower the validation ROC-AUC
+        """
+        gain_share = importances["total_gain"] / importances["total_gain"].sum()
+        is_covered = gain_share.cumsum().shift(fill_value=0) < self.importance_coverage
+        selected = importances.index[is_covered & (importances["permutation_mean"] > 0)]
+        if selected.empty:
+            raise ValueError("No feature passed the importance selection")
+        return selected.tolist()
+
+    def save_feature_manifest(self):
+        """Features the saved model expects, with the importances they were picked on"""
+        manifest = dict(
+            created_on=dt.now().isoformat(),
+            target=self.get_training_columns("target")[0],
+            features=self.get_training_columns("features"),
+            importances=self.feature_importances.to_dict(orient="index"),
+        )
+        write_file_to_s3(self.feature_manifest_path, json.dumps(manifest, indent=2))
+
     def save_model_and_metadata(
         self,
         model: xgb.XGBClassifier,
         roc_auc: float,
         report: str,
     ):
-        write_file_to_s3(self.model_path, model, is_pickle=True)
+        self.save_feature_manifest()
         x, _, _, _, _, _ = self.get_datasets()
         pairs = self.pre_processed_df["pair"].unique().tolist()
         metadata = dict(
             trained_on=dt.now().isoformat(),
             dataset_size=len(x),
+            features_count=len(x.columns),
             included_pairs=pairs,
             train_size=self.train_size,
             validate_size=self.validate_size,
             test_size=self.test_size,
             roc_auc=roc_auc,
         )
+        MODEL_REGISTRY.save(model, self.model_name, metadata)
         content = ""
         for k, v in metadata.items():
             content += f"- {k}: {v}\n"
         content += f"\n\nTRAINING RESULTS:\n\n{report}"
         write_file_to_s3(f"{self.assets_path}/{self.model_name}_metadata.txt", content)
 
-    async def train(self, with_optimization: bool, pairs: list[str] = None):
-        await self.pre_process_data(pairs=pairs)
-        self.split()
-        if with_optimization:
-            self.hyper_parameter_tuning()
-            # self.time_series_cross_validation(best_params)
+    def fit_model(self) -> tuple[xgb.XGBClassifier, float, str]:
         model = xgb.XGBClassifier(**self.model_base_params)
         train_x, train_y, val_x, val_y, test_x, test_y = self.get_datasets()
         model.fit(
@@ -322,8 +708,38 @@ class Train(TrainingOptimization):
             model.predict_proba(test_x)[:, 1],
         )
         report = classification_report(test_y, model.predict(test_x))
-        self.save_model_and_metadata(model=model, roc_auc=roc_auc, report=report)
         self.log.info(f"Test ROC-AUC: {roc_auc:.3f}")
+        return model, roc_auc, report
+
+    async def train(
+        self,
+        with_optimization: bool,
+        pairs: list[str] = None,
+        tuning_workers: int = 1,
+        with_feature_selection: bool = False,
+    ):
+        """
+        The gain and permutation importances are recorded in the feature manifest.
+        With feature selection, the model is retrained on the most important
+        features only, and inference then only computes those
+        """
+        await self.pre_process_data(pairs=pairs)
+        self.selected_features = None
+        self.split()
+        if with_optimization:
+            self.hyper_parameter_tuning(n_workers=tuning_workers)
+            # self.time_series_cross_validation(best_params)
+        model, roc_auc, report = self.fit_model()
+        self.feature_importances = self.get_feature_importances(model)
+        if with_feature_selection:
+            self.selected_features = self.select_features(self.feature_importances)
+            self.log.info(
+                f"Retraining on {len(self.selected_features)} of "
+                f"{len(self.feature_importances)} features"
+            )
+            self.split()
+            model, roc_auc, report = self.fit_model()
+        self.save_model_and_metadata(model=model, roc_auc=roc_auc, report=report)
         print(report)
 
 
@@ -3,7 +3,6 @@ import os
 import sys
 import warnings
 
-import aiohttp
 import ccxt.async_support as ccxt
 import pandas as pd
 import pandas_ta as ta
@@ -14,7 +13,7 @@ from indicators import vbp, fractals
 warnings.filterwarnings("ignore")
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
 
-from utils import helpers  # noqa: E402
+from utils import helpers, pools  # noqa: E402
 
 WS_PORT = 8768
 LOG = helpers.get_logger("screening_service")
@@ -65,24 +64,21 @@ class ExchangeScreener:
             LOG.info("Downloading OHLCV data")
         try:
             url = f"{helpers.BASE_API}/ohlc/?exchange=coinbase&timeframe=1d&full_history=y"
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as ohlc_data:
-                    error_message = await ohlc_data.text() if not ohlc_data.ok else None
-                    if not error_message:
-                        ohlc_data = await ohlc_data.json()
-                        self.data["ohlcv"] = pd.DataFrame(
-                            data=ohlc_data,
-                            columns=[
-                                "timestamp",
-                                "open",
-                                "high",
-                                "low",
-                                "close",
-                                "volume",
-                                "pair",
-                                "insert_tmstmp",
-                            ],
-                        )
+            ohlc_data = await pools.a_get_json(url)
+            self.data["ohlcv"] = pd.DataFrame(
+                data=ohlc_data,
+                columns=[
+                    "timestamp",
+                    "open",
+                    "high",
+                    "low",
+                    "close",
+                    "volume",
+                    "pair",
+                    "insert_tmstmp",
+                ],
+            )
+            error_message = None
         except Exception as e:
             error_message = e
         if error_message:
@@ -262,8 +258,8 @@ class Screener:
 
     async def get_exchanges_mappings(self):
         for exchange in self.exchange_list:
-            exchange_object = helpers.get_exchange_object(exchange, async_mode=True)
-            symbols = await exchange_object.load_markets()
+            exchange_object = await pools.a_get_exchange(exchange)
+            symbols = exchange_object.markets
             filtered_symbols = dict()
             for symbol, details in symbols.items():
                 if await self.is_pair_in_scope(details):
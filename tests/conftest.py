@@ -0,0 +1,39 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+
+@pytest.fixture
+def no_database(monkeypatch):
+    """Pipeline objects built without connecting to the database"""
+    import services.ai.indicators
+
+    monkeypatch.setattr(services.ai.indicators, "get_db_connection", lambda: None)
+
+
+@pytest.fixture
+def trades():
+    """Daily outcomes of a few pairs, with missing values, and buy signals"""
+    rng = np.random.default_rng(0)
+    n_rows = 500
+    df = pd.DataFrame(
+        dict(
+            pair=np.tile(["BTC/USD", "ETH/USD", "SOL/USD", "ADA/USD"], n_rows // 4),
+            calendar_dt=np.repeat(
+                pd.date_range("2023-01-01", periods=n_rows // 4, tz="UTC"), 4
+            ),
+            day_drawdown=-np.abs(rng.normal(0, 0.02, n_rows)),
+            day_peak=np.abs(rng.normal(0, 0.03, n_rows)),
+            day_return=rng.normal(0, 0.02, n_rows),
+            prediction=rng.uniform(size=n_rows),
+        )
+    )
+    df.loc[rng.choice(n_rows, 20), "day_return"] = np.nan
+    df.loc[rng.choice(n_rows, 20), "day_drawdown"] = np.nan
+    df["model_buy"] = df["prediction"] > 0.5
+    return df
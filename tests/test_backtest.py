@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from services.ai.backtest import BackTest
+
+THRESHOLDS = np.arange(1, 101) / 100
+
+
+@pytest.fixture
+def backtest(no_database, trades) -> BackTest:
+    backtest = BackTest(target_type="take_profit", pairs=None)
+    # predictions already aligned to the day they are traded
+    backtest.predictions_df = trades.drop(columns="model_buy")
+    return backtest
+
+
+def test_sweep_matches_backtest_per_threshold(backtest):
+    sweep = backtest.sweep_confidence_thresholds(THRESHOLDS)
+    expected = [backtest.backtest(confidence_threshold=t) for t in THRESHOLDS]
+    np.testing.assert_array_equal(sweep["threshold"], THRESHOLDS)
+    np.testing.assert_allclose(sweep["final_pnl"], expected, rtol=1e-12, atol=1e-15)
+
+
+def test_sweep_chunks_give_the_same_result(backtest):
+    sweep = backtest.sweep_confidence_thresholds(THRESHOLDS)
+    # a single threshold per chunk
+    backtest.max_sweep_cells = 1
+    chunked_sweep = backtest.sweep_confidence_thresholds(THRESHOLDS)
+    np.testing.assert_array_equal(chunked_sweep["final_pnl"], sweep["final_pnl"])
+
+
+def get_loop_portfolio(
+    backtest: BackTest,
+    threshold: float,
+    weighting: str,
+    capital_fraction: float,
+) -> list[float]:
+    """Balance after every day, the day's trades sharing the capital"""
+    df = backtest.get_predictions()
+    trading_costs = 2 * (backtest.fee_rate + backtest.slippage)
+    balance = backtest.starting_balance
+    balances = []
+    for _, day_df in df.groupby("calendar_dt", sort=True):
+        trades = day_df[day_df["prediction"] > threshold]
+        day_pnl = 0.0
+        if len(trades):
+            if weighting == "equal":
+                weights = np.full(len(trades), 1 / len(trades))
+            else:
+                weights = trades["prediction"] / trades["prediction"].sum()
+            pnl = backtest.get_pnl(trades.assign(model_buy=True)) - trading_costs
+            day_pnl = float(np.sum(weights * pnl))
+        balance += balance * capital_fraction * day_pnl
+        balances.append(balance)
+    return balances
+
+
+@pytest.mark.parametrize("weighting", ["equal", "confidence"])
+@pytest.mark.parametrize("capital_fraction", [1, 0.3])
+def test_portfolio_backtest_matches_daily_loop(backtest, weighting, capital_fraction):
+    # no buy signal on the first day
+    first_day = backtest.predictions_df["calendar_dt"].min()
+    is_first_day = backtest.predictions_df["calendar_dt"] == first_day
+    backtest.predictions_df.loc[is_first_day, "prediction"] = 0.0
+    final_pnl = backtest.portfolio_backtest(
+        confidence_threshold=0.6,
+        weighting=weighting,
+        capital_fraction=capital_fraction,
+    )
+    balances = get_loop_portfolio(backtest, 0.6, weighting, capital_fraction)
+    results = backtest.portfolio_results
+    assert results["trades"].iloc[0] == 0
+    assert results["balance"].iloc[0] == backtest.starting_balance
+    np.testing.assert_allclose(results["balance"], balances, rtol=1e-12)
+    np.testing.assert_allclose(
+        results["usd_pnl"], np.diff(balances, prepend=backtest.starting_balance)
+    )
+    assert final_pnl == pytest.approx(balances[-1] / backtest.starting_balance - 1)
@@ -0,0 +1,167 @@
+import asyncio
+import copy
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from services.ai.features import FEATURE_REGISTRY, FeatureGroup
+from services.ai.indicators import Indicators
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+PAIRS = ["BTC/USD", "ETH/USD", "SOL/USD"]
+N_DAYS = 400
+
+
+def get_raw_data(rng: np.random.Generator, dates: np.ndarray) -> pd.DataFrame:
+    """Rows of the formatted_data view"""
+    frames = []
+    for i, pair in enumerate(PAIRS):
+        close = 100 * (i + 1) * np.exp(np.cumsum(rng.normal(0, 0.03, N_DAYS)))
+        open_ = np.r_[close[0], close[:-1]] * (1 + rng.normal(0, 0.005, N_DAYS))
+        high = np.maximum(open_, close) * (1 + np.abs(rng.normal(0, 0.02, N_DAYS)))
+        low = np.minimum(open_, close) * (1 - np.abs(rng.normal(0, 0.02, N_DAYS)))
+        df = pd.DataFrame(
+            dict(calendar_dt=dates, pair=pair, open=open_, high=high, low=low)
+        )
+        df["close"] = close
+        df["day_peak"] = high / open_ - 1
+        df["day_drawdown"] = low / open_ - 1
+        df["day_return"] = close / open_ - 1
+        df["usd_volume"] = rng.uniform(1e5, 1e6, N_DAYS) * close
+        for level, price in (("fractal", 0.9), ("poc", 0.95)):
+            df[f"{level}_support"] = low * price
+            df[f"has_crossed_{level}_support"] = 0
+            df[f"{level}_resistance"] = high / price
+            df[f"has_crossed_{level}_resistance"] = 0
+        df["distance_to_ath"] = close / np.maximum.accumulate(high) - 1
+        df["distance_to_atl"] = close / np.minimum.accumulate(low) - 1
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+def get_api_datasets(rng: np.random.Generator, dates: np.ndarray) -> dict:
+    """Datasets otherwise downloaded from coinalyze, alternative.me and yahoo"""
+
+    def get_dataset(**columns: str) -> pd.DataFrame:
+        df = pd.DataFrame(dict(calendar_dt=dates))
+        for col in columns.values():
+            df[col] = rng.uniform(1, 100, N_DAYS)
+        return df
+
+    return dict(
+        open_interest=get_dataset(c="btc_usd_open_interest"),
+        funding_rates=get_dataset(c="btc_usd_funding_rate"),
+        liquidations=get_dataset(l="longs_liquidations", s="shorts_liquidations"),
+        long_short_ratio=get_dataset(r="ls_ratio"),
+        greed_and_fear=get_dataset(value="greed_and_fear_index"),
+        vix=get_dataset(r="vix_1d_return", c="vix"),
+        gold=get_dataset(r="gold_1d_return"),
+        nasdaq=get_dataset(r="nasdaq_1d_return"),
+    )
+
+
+async def add_pair_indicators_sequentially(indicators: Indicators):
+    """The serial pipeline the registry replaced"""
+    indicators.add_target()
+    indicators.add_trend_indicators()
+    indicators.add_price_indicators()
+    indicators.add_derivatives_indicators()
+    indicators.add_momentum_indicators()
+    indicators.add_volatility_indicators()
+    indicators.add_volume_indicators()
+    await indicators.add_market_beta_indicators()
+    indicators.add_macro_indicators()
+    indicators.add_seasonality()
+    indicators.add_patterns()
+    indicators.pair_df = indicators.pair_df.astype(
+        indicators.get_compact_dtypes(indicators.pair_df)
+    )
+
+
+@pytest.fixture
+def get_indicators(no_database, monkeypatch):
+    # the macro and bitcoin dominance datasets are read from the repository assets
+    monkeypatch.chdir(ROOT)
+    rng = np.random.default_rng(0)
+    dates = pd.date_range("2020-01-01", periods=N_DAYS).date
+    raw_data = get_raw_data(rng, dates)
+    datasets = get_api_datasets(rng, dates)
+
+    def get_indicators(pair: str, required_features: list[str] = None) -> Indicators:
+        indicators = Indicators(target_type="take_profit")
+        indicators.raw_data = raw_data
+        indicators.datasets = copy.deepcopy(datasets)
+        indicators.required_features = required_features
+        indicators.pair_df = raw_data[raw_data["pair"] == pair]
+        return indicators
+
+    return get_indicators
+
+
+@pytest.mark.parametrize("pair", PAIRS)
+def test_registry_matches_serial_pipeline(get_indicators, pair):
+    expected = get_indicators(pair)
+    asyncio.run(add_pair_indicators_sequentially(expected))
+    indicators = get_indicators(pair)
+    asyncio.run(indicators.add_pair_indicators())
+    pd.testing.assert_frame_equal(
+        indicators.pair_df, expected.pair_df.reset_index(drop=True)
+    )
+
+
+def test_required_features_match_full_pipeline(get_indicators):
+    required = ["rsi", "vix", "CDLDOJI"]
+    full = get_indicators("ETH/USD")
+    asyncio.run(full.add_pair_indicators())
+    indicators = get_indicators("ETH/USD", required_features=required)
+    asyncio.run(indicators.add_pair_indicators())
+    # neither derivatives nor macro indicators are computed
+    assert "ls_ratio" not in indicators.pair_df
+    assert "days_to_next_nfp" not in indicators.pair_df
+    pd.testing.assert_frame_equal(indicators.pair_df[required], full.pair_df[required])
+
+
+def test_group_changing_rows_is_rejected():
+    group = FeatureGroup(name="group", method="", inputs=[], outputs=["a"])
+    df = pd.DataFrame(dict(a=[1.0, 2.0], b=[1, 2]))
+    with pytest.raises(ValueError, match="rows"):
+        FEATURE_REGISTRY.check_output(group, df, df.iloc[1:])
+
+
+def test_group_overwriting_undeclared_columns_is_rejected():
+    group = FeatureGroup(name="group", method="", inputs=["b"], outputs=["a"])
+    df = pd.DataFrame(dict(a=[1.0, np.nan], b=[1, 2]))
+    FEATURE_REGISTRY.check_output(group, df, df.assign(a=[3.0, 4.0], c=1))
+    with pytest.raises(ValueError, match=r"\['b'\]"):
+        FEATURE_REGISTRY.check_output(group, df, df.assign(b=[2, 1]))
+    with pytest.raises(ValueError, match=r"\['b'\]"):
+        FEATURE_REGISTRY.check_output(group, df, df.drop(columns="b"))
+
+
+def test_groups_get_their_declared_columns_and_shared_datasets():
+    seen = dict()
+
+    class Worker:
+        def __init__(self):
+            self.datasets = dict(macro=pd.DataFrame(dict(a=[1])))
+
+        def method(self):
+            seen[self.group] = (list(self.pair_df), self.datasets["macro"])
+
+    df = pd.DataFrame(dict(a=[1.0], b=[2.0], c=[3.0]))
+    worker = Worker()
+    for name, writes_datasets in [("reads", False), ("writes", True)]:
+        group = FeatureGroup(
+            name=name,
+            method="method",
+            inputs=["a"],
+            outputs=["c"],
+            writes_datasets=writes_datasets,
+        )
+        worker.group = name
+        asyncio.run(FEATURE_REGISTRY.compute(worker, group, df[["a", "c"]], None))
+    assert seen["reads"][0] == ["a", "c"]
+    assert seen["reads"][1] is worker.datasets["macro"]
+    assert seen["writes"][1] is not worker.datasets["macro"]
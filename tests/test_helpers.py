@@ -0,0 +1,108 @@
+import asyncio
+
+import ccxt
+import pytest
+
+from utils import helpers, retries
+
+DAY = helpers.UNITS_TO_MILLISECONDS["d"]
+# timestamp of the latest daily candle
+NOW = 20_000 * DAY
+
+
+class FakeExchange:
+    """
+    Daily candles of a pair listed n_candles days ago. Like most exchanges, the
+    limit is capped to the maximum page size, and a request since a timestamp
+    returns the following candles, even past the requested window.
+    """
+
+    def __init__(self, n_candles: int, max_limit: int, described: bool = True):
+        self.candles = [
+            [NOW - (n_candles - 1 - i) * DAY, 1.0, 2.0, 0.5, 1.5, 10.0]
+            for i in range(n_candles)
+        ]
+        self.max_limit = max_limit
+        self.features = dict(spot=dict(fetchOHLCV=dict(limit=max_limit)))
+        if not described:
+            self.features = dict(spot=None)
+        self.requests = []
+        # requests failing once, by since
+        self.failing = set()
+
+    async def fetch_ohlcv(self, symbol: str, timeframe: str, limit: int, since: int):
+        self.requests.append(since)
+        if since in self.failing:
+            self.failing.remove(since)
+            raise ccxt.RequestTimeout("timeout")
+        await asyncio.sleep(0)
+        limit = min(limit, self.max_limit)
+        if since is None:
+            return self.candles[-limit:]
+        return [candle for candle in self.candles if candle[0] >= since][:limit]
+
+
+def get_history(exchange: FakeExchange, from_tmstmp: int = None) -> list:
+    return asyncio.run(
+        helpers.a_get_ohlcv_history("BTC/USD", exchange, "1d", from_tmstmp)
+    )
+
+
+def get_timestamps(candles: list) -> list[int]:
+    return [candle[0] for candle in candles]
+
+
+@pytest.mark.parametrize("described", [True, False])
+@pytest.mark.parametrize("n_candles", [1000, 2999, 3000, 7777])
+def test_full_history_is_covered_once(n_candles, described):
+    exchange = FakeExchange(n_candles, max_limit=1000, described=described)
+    history = get_history(exchange)
+    assert get_timestamps(history) == get_timestamps(exchange.candles)
+
+
+@pytest.mark.parametrize("days", [1, 999, 1000, 1001, 4321])
+def test_history_since_from_tmstmp(days):
+    exchange = FakeExchange(7777, max_limit=1000)
+    from_tmstmp = NOW - days * DAY
+    history = get_history(exchange, from_tmstmp)
+    assert get_timestamps(history) == list(range(from_tmstmp, NOW + DAY, DAY))
+    # no window is requested before from_tmstmp
+    assert all(since is None or since >= from_tmstmp for since in exchange.requests)
+
+
+def test_windows_do_not_overlap():
+    exchange = FakeExchange(7777, max_limit=1000)
+    get_history(exchange)
+    windows = sorted(exchange.requests[1:])
+    assert len(windows) == len(set(windows))
+    assert all(end - start == 1000 * DAY for start, end in zip(windows, windows[1:]))
+
+
+def test_short_latest_page_is_the_whole_history():
+    exchange = FakeExchange(250, max_limit=1000)
+    assert len(get_history(exchange)) == 250
+    assert exchange.requests == [None]
+
+
+def test_unknown_history_is_empty():
+    exchange = FakeExchange(0, max_limit=1000)
+    assert get_history(exchange) == []
+    assert exchange.requests == [None]
+
+
+def test_stops_at_the_first_empty_window():
+    exchange = FakeExchange(2500, max_limit=1000)
+    history = get_history(exchange)
+    assert len(history) == 2500
+    # the latest page, then a single batch of windows reaching the listing date
+    assert len(exchange.requests) == 1 + helpers.MAX_CONCURRENT_OHLCV_REQUESTS
+
+
+def test_failed_windows_are_retried(monkeypatch):
+    monkeypatch.setattr(retries, "BASE_BACKOFF", 0)
+    exchange = FakeExchange(3000, max_limit=1000)
+    oldest = exchange.candles[-1000][0]
+    exchange.failing = {oldest - 1000 * DAY, oldest - 3000 * DAY}
+    history = get_history(exchange)
+    assert get_timestamps(history) == get_timestamps(exchange.candles)
+    assert not exchange.failing
@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+import talib
+
+from services.ai.indicators import Indicators
+
+
+def test_compact_dtypes_downcast_exact_floats_only():
+    df = pd.DataFrame(
+        dict(
+            halves=[0.5, 1.5, np.nan],
+            # not representable in float32, rounding changes the values
+            prices=[0.1, 27_431.17, 1e-3],
+            pattern=[0, 100, -200],
+        )
+    )
+    dtypes = Indicators.get_compact_dtypes(df, with_floats=True)
+    assert dtypes == dict(halves=np.float32, pattern=np.int16)
+
+
+def test_compact_dtypes_float32_columns():
+    df = pd.DataFrame(
+        dict(feature=[0.1, 0.2, np.nan], day_return=[0.1, 0.2, 0.3], big=[1e300, 1, 2])
+    )
+    dtypes = Indicators.get_compact_dtypes(
+        df,
+        with_floats=True,
+        float64_columns=["day_return"],
+        float32_columns=["feature", "day_return", "big"],
+    )
+    # day_return is kept as float64, big would overflow
+    assert dtypes == dict(feature=np.float32)
+
+
+def test_patterns_match_sequential_talib(no_database):
+    rng = np.random.default_rng(0)
+    n_rows = 1000
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.03, n_rows)))
+    open_ = np.r_[close[0], close[:-1]] * (1 + rng.normal(0, 0.01, n_rows))
+    pair_df = pd.DataFrame(
+        dict(
+            open=open_,
+            high=np.maximum(open_, close) * (1 + np.abs(rng.normal(0, 0.02, n_rows))),
+            low=np.minimum(open_, close) * (1 - np.abs(rng.normal(0, 0.02, n_rows))),
+            close=close,
+        )
+    )
+    pair_df["sma_50"] = talib.SMA(pair_df["close"], timeperiod=50)
+    pair_df["sma_200"] = talib.SMA(pair_df["close"], timeperiod=200)
+    indicators = Indicators(target_type="take_profit")
+    indicators.pair_df = pair_df
+    indicators.pattern_workers = 4
+    indicators.add_patterns()
+
+    patterns = indicators.candlestick_patterns
+    assert (indicators.pair_df[patterns].dtypes == np.int16).all()
+    matched = 0
+    for pattern in patterns:
+        expected = getattr(talib, pattern)(
+            pair_df["open"], pair_df["high"], pair_df["low"], pair_df["close"]
+        )
+        np.testing.assert_array_equal(indicators.pair_df[pattern], expected)
+        matched += (expected != 0).any()
+    # the fixture exercises most patterns
+    assert matched > len(patterns) / 2
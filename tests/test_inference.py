@@ -0,0 +1,54 @@
+import json
+
+import numpy as np
+import pytest
+import xgboost as xgb
+
+from services.ai import inference, pre_process
+from services.ai.inference import PredictionService
+
+
+@pytest.fixture
+def service(no_database, monkeypatch, tmp_path) -> PredictionService:
+    """Service reading its artifacts from a local directory"""
+    monkeypatch.setattr(pre_process, "load_from_s3", lambda file_name: None)
+    service = PredictionService(target_type="take_profit")
+    service.scalers_path = str(tmp_path / "pair_scalers.npz")
+    service.encoded_pairs_path = str(tmp_path / "pair_encode.json")
+    service.feature_manifest_path = str(tmp_path / "features.json")
+    return service
+
+
+def save_training_artifacts(service: PredictionService, version: int):
+    """Scalers and pair encodings a training run saves next to its model"""
+    n_columns = len(service.standardized_columns)
+    np.savez(
+        service.scalers_path,
+        pairs=np.array(["BTC/USD", "ETH/USD"]),
+        columns=np.array(service.standardized_columns),
+        mean=np.full((2, n_columns), float(version)),
+        scale=np.ones((2, n_columns)),
+    )
+    with open(service.encoded_pairs_path, "w") as f:
+        json.dump({"BTC/USD": version / 10, "ETH/USD": -version / 10}, f)
+
+
+def test_new_model_reloads_scalers_and_pair_encoding(service, monkeypatch):
+    saved = dict(model=xgb.Booster())
+    monkeypatch.setattr(inference.MODEL_REGISTRY, "load", lambda name: saved["model"])
+    save_training_artifacts(service, version=1)
+    service.load_model()
+    assert service.pair_scalers["mean"][0, 0] == 1
+    assert service.encoded_pair_to_pair(0.1) == "BTC/USD"
+
+    # a retraining saves new artifacts, then its model
+    save_training_artifacts(service, version=2)
+    service.load_model()
+    assert service.pair_scalers["mean"][0, 0] == 1
+    saved["model"] = xgb.Booster()
+    service.load_model()
+    assert service.pair_scalers["mean"][0, 0] == 2
+    assert service.get_pair_encoding_mapping() == {"BTC/USD": 0.2, "ETH/USD": -0.2}
+    assert service.encoded_pair_to_pair(-0.2) == "ETH/USD"
+    with pytest.raises(ValueError, match="Unknown pair"):
+        service.encoded_pair_to_pair(0.1)
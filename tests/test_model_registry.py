@@ -0,0 +1,76 @@
+import json
+
+import numpy as np
+import pytest
+import xgboost as xgb
+from botocore.exceptions import EndpointConnectionError
+
+from services.ai.model_registry import ModelRegistry
+from utils import helpers, retries
+
+MODEL_NAME = "test_model"
+
+
+class UnreachableS3Client:
+    def head_object(self, **kwargs):
+        raise EndpointConnectionError(endpoint_url="https://s3.amazonaws.com")
+
+    def download_file(self, *args, **kwargs):
+        raise EndpointConnectionError(endpoint_url="https://s3.amazonaws.com")
+
+
+@pytest.fixture
+def s3_outage(monkeypatch):
+    monkeypatch.setattr(helpers, "get_s3_client", UnreachableS3Client)
+    monkeypatch.setattr(retries, "BASE_BACKOFF", 0)
+
+
+@pytest.fixture
+def registry(tmp_path) -> ModelRegistry:
+    """Registry with a model saved in its assets, as after a previous download"""
+    registry = ModelRegistry()
+    registry.assets_path = tmp_path
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(200, 3))
+    booster = xgb.train(
+        dict(objective="binary:logistic"),
+        xgb.DMatrix(x, label=x[:, 0] > 0),
+        num_boost_round=5,
+    )
+    model_path = registry.get_model_path(MODEL_NAME)
+    booster.save_model(model_path)
+    metadata = dict(sha256=registry.get_sha256(model_path))
+    registry.get_metadata_path(MODEL_NAME).write_text(json.dumps(metadata))
+    return registry
+
+
+def test_s3_etag_is_none_when_s3_is_unreachable(s3_outage):
+    assert helpers.get_s3_etag(f"{MODEL_NAME}.ubj") is None
+
+
+def test_s3_calls_are_retried(monkeypatch):
+    class FlakyS3Client:
+        calls = 0
+
+        def head_object(self, **kwargs):
+            FlakyS3Client.calls += 1
+            if FlakyS3Client.calls < helpers.S3_ATTEMPTS:
+                raise EndpointConnectionError(endpoint_url="https://s3.amazonaws.com")
+            return dict(ETag='"etag"')
+
+    monkeypatch.setattr(helpers, "get_s3_client", FlakyS3Client)
+    monkeypatch.setattr(retries, "BASE_BACKOFF", 0)
+    assert helpers.get_s3_etag(f"{MODEL_NAME}.ubj") == '"etag"'
+    assert FlakyS3Client.calls == helpers.S3_ATTEMPTS
+
+
+def test_load_uses_the_cached_model_when_s3_is_unreachable(registry, s3_outage):
+    booster = xgb.Booster()
+    registry.models[MODEL_NAME] = ('"etag"', booster)
+    assert registry.load(MODEL_NAME) is booster
+
+
+def test_load_uses_the_local_model_when_s3_is_unreachable(registry, s3_outage):
+    booster = registry.load(MODEL_NAME)
+    assert booster.num_boosted_rounds() == 5
+    assert registry.models[MODEL_NAME] == (None, booster)
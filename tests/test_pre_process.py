@@ -0,0 +1,69 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from services.ai import pre_process
+from services.ai.pre_process import PreProcessing
+
+
+@pytest.fixture
+def pre_processing(no_database, monkeypatch, tmp_path) -> PreProcessing:
+    """Training pre-processing with its scalers stored in a local directory"""
+    monkeypatch.setattr(pre_process, "load_from_s3", lambda file_name: None)
+    monkeypatch.setattr(pre_process, "upload_to_s3", lambda local_path: None)
+    pre_processing = PreProcessing(is_training=True, target_type="take_profit")
+    pre_processing.scalers_path = str(tmp_path / "pair_scalers.npz")
+    pre_processing.feature_manifest_path = str(tmp_path / "features.json")
+    return pre_processing
+
+
+def fit_scalers(pre_processing: PreProcessing, pairs: list[str], seed: int) -> dict:
+    rng = np.random.default_rng(seed)
+    columns = pre_processing.standardized_columns
+    pre_processing.pre_processed_df = pd.DataFrame(
+        rng.normal(size=(10 * len(pairs), len(columns))), columns=columns
+    ).assign(pair=np.repeat(pairs, 10))
+    scalers = pre_processing.fit_pair_scalers()
+    pre_processing.save_pair_scalers(scalers)
+    return scalers
+
+
+def get_pair_rows(scalers: dict, pair: str) -> tuple[np.ndarray, np.ndarray]:
+    i = scalers["pairs"].tolist().index(pair)
+    return scalers["mean"][i], scalers["scale"][i]
+
+
+def test_saving_a_subset_of_pairs_keeps_the_other_scalers(pre_processing):
+    all_pairs = fit_scalers(pre_processing, ["BTC/USD", "ETH/USD", "SOL/USD"], seed=0)
+    subset = fit_scalers(pre_processing, ["ETH/USD"], seed=1)
+    pre_processing.pair_scalers = dict()
+    stored = pre_processing.load_pair_scalers()
+    assert sorted(stored["pairs"]) == ["BTC/USD", "ETH/USD", "SOL/USD"]
+    for pair, expected in [
+        ("BTC/USD", all_pairs),
+        ("SOL/USD", all_pairs),
+        ("ETH/USD", subset),
+    ]:
+        for stored_row, expected_row in zip(
+            get_pair_rows(stored, pair), get_pair_rows(expected, pair)
+        ):
+            np.testing.assert_array_equal(stored_row, expected_row)
+
+
+def test_scalers_of_other_columns_are_replaced(pre_processing):
+    fit_scalers(pre_processing, ["BTC/USD", "ETH/USD"], seed=0)
+    pre_processing.standardized_columns = pre_processing.standardized_columns[:-1]
+    fit_scalers(pre_processing, ["ETH/USD"], seed=1)
+    pre_processing.pair_scalers = dict()
+    assert pre_processing.load_pair_scalers()["pairs"].tolist() == ["ETH/USD"]
+
+
+def test_feature_manifest(pre_processing):
+    # a model saved before the manifests, every feature is used
+    assert pre_processing.load_feature_manifest() is None
+    manifest = dict(target="hit_take_profit", features=["rsi", "vix"])
+    with open(pre_processing.feature_manifest_path, "w") as f:
+        json.dump(manifest, f)
+    assert pre_processing.load_feature_manifest() == ["rsi", "vix"]
@@ -0,0 +1,182 @@
+import asyncio
+from datetime import datetime as dt, timedelta, timezone
+from email.utils import format_datetime
+
+import aiohttp
+import ccxt
+import pytest
+import requests
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+from utils import retries
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, delay: float):
+        self.sleeps.append(delay)
+        self.now += delay
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    """Time of the retries module, advanced by its sleeps only"""
+    clock = FakeClock()
+    monkeypatch.setattr(retries.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(retries.time, "sleep", clock.sleep)
+    monkeypatch.setattr(retries, "_BUCKETS", dict())
+    return clock
+
+
+def get_http_error(status: int, headers: dict = None) -> requests.HTTPError:
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or dict())
+    return requests.HTTPError(response=response)
+
+
+def get_client_error(status: int, headers: dict = None) -> ClientError:
+    metadata = dict(HTTPStatusCode=status, HTTPHeaders=headers or dict())
+    return ClientError(dict(ResponseMetadata=metadata), "HeadObject")
+
+
+@pytest.mark.parametrize(
+    "error, expected",
+    [
+        (ConnectionError(), True),
+        (asyncio.TimeoutError(), True),
+        (ccxt.RequestTimeout(), True),
+        (ccxt.BadSymbol(), False),
+        (requests.ConnectionError(), True),
+        (get_http_error(429), True),
+        (get_http_error(503), True),
+        (get_http_error(404), False),
+        (aiohttp.ClientResponseError(None, (), status=502), True),
+        (aiohttp.ClientResponseError(None, (), status=401), False),
+        (EndpointConnectionError(endpoint_url="https://s3.amazonaws.com"), True),
+        (get_client_error(503), True),
+        (get_client_error(403), False),
+        (ValueError(), False),
+    ],
+)
+def test_retryable_errors(error, expected):
+    assert retries.is_retryable(error) == expected
+
+
+def test_retry_after_in_seconds():
+    assert retries.get_retry_after(get_http_error(429, {"Retry-After": "7"})) == 7
+    error = aiohttp.ClientResponseError(
+        None, (), status=429, headers={"Retry-After": "1.5"}
+    )
+    assert retries.get_retry_after(error) == 1.5
+    # botocore lowercases the header names
+    assert retries.get_retry_after(get_client_error(503, {"retry-after": "3"})) == 3
+
+
+def test_retry_after_as_http_date():
+    retry_at = dt.now(tz=timezone.utc) + timedelta(seconds=30)
+    headers = {"Retry-After": format_datetime(retry_at, usegmt=True)}
+    assert retries.get_retry_after(get_http_error(503, headers)) == pytest.approx(
+        30, abs=2
+    )
+    past = format_datetime(retry_at - timedelta(hours=1), usegmt=True)
+    assert retries.get_retry_after(get_http_error(503, {"Retry-After": past})) == 0
+
+
+def test_retry_after_missing_or_invalid():
+    assert retries.get_retry_after(get_http_error(503)) is None
+    assert retries.get_retry_after(ConnectionError()) is None
+    error = get_http_error(503, {"Retry-After": "soon"})
+    assert retries.get_retry_after(error) is None
+
+
+def test_backoff_is_capped_and_jittered(monkeypatch):
+    for attempt in range(12):
+        cap = min(retries.MAX_BACKOFF, retries.BASE_BACKOFF * 2**attempt)
+        delays = [retries.get_backoff(attempt) for _ in range(200)]
+        assert all(0 <= delay <= cap for delay in delays)
+        # full jitter: delays spread over the whole range
+        assert min(delays) < cap / 4 and max(delays) > 3 * cap / 4
+    monkeypatch.setattr(retries.random, "uniform", lambda low, high: high)
+    assert retries.get_backoff(3) == retries.BASE_BACKOFF * 8
+    assert retries.get_backoff(50) == retries.MAX_BACKOFF
+
+
+def test_bucket_refill_rate(clock):
+    bucket = retries.TokenBucket(rate=2, capacity=2)
+    # a burst of capacity requests, then one request every 1 / rate seconds
+    assert [bucket.reserve() for _ in range(2)] == [0, 0]
+    assert bucket.reserve() == pytest.approx(0.5)
+    assert bucket.reserve() == pytest.approx(1.0)
+    clock.now = 1.0
+    assert bucket.reserve() == pytest.approx(0.5)
+    # refills up to the capacity only
+    clock.now = 100.0
+    assert [bucket.reserve() for _ in range(2)] == [0, 0]
+    assert bucket.reserve() == pytest.approx(0.5)
+
+
+def test_blocked_bucket(clock):
+    bucket = retries.TokenBucket(rate=10)
+    bucket.block(5)
+    assert bucket.reserve() == 5
+    clock.now = 5.0
+    assert bucket.reserve() == 0
+
+
+def test_call_with_retries(clock):
+    calls = []
+
+    @retries.call_with_retries(max_attempts=4)
+    def fetch(fails: int, error: Exception):
+        calls.append(error)
+        if len(calls) <= fails:
+            raise error
+        return "ok"
+
+    assert fetch(fails=3, error=ConnectionError()) == "ok"
+    assert len(calls) == 4 and len(clock.sleeps) == 3
+    calls.clear()
+    with pytest.raises(ConnectionError):
+        fetch(fails=4, error=ConnectionError())
+    assert len(calls) == 4
+    calls.clear()
+    with pytest.raises(ValueError):
+        fetch(fails=1, error=ValueError())
+    assert len(calls) == 1
+
+
+def test_retry_after_blocks_the_host(clock):
+    host = "api.example.com"
+    calls = []
+
+    def fetch():
+        calls.append(clock.now)
+        if len(calls) == 1:
+            raise get_http_error(429, {"Retry-After": "12"})
+        return "ok"
+
+    assert retries.call_with_retries(fetch, host=host)() == "ok"
+    assert calls[1] - calls[0] == pytest.approx(12)
+    # the other callers of the host wait as well
+    assert retries.get_bucket(host).blocked_until == pytest.approx(12)
+
+
+def test_a_call_with_retries(monkeypatch):
+    monkeypatch.setattr(retries, "BASE_BACKOFF", 0)
+    calls = []
+
+    async def fetch():
+        calls.append(None)
+        if len(calls) < 3:
+            raise aiohttp.ClientConnectionError()
+        return "ok"
+
+    assert asyncio.run(retries.a_call_with_retries(fetch, max_attempts=3)()) == "ok"
+    assert len(calls) == 3
@@ -0,0 +1,115 @@
+import asyncio
+
+import numpy as np
+import pandas as pd
+import pytest
+import xgboost as xgb
+
+from services.ai.train import Train
+
+
+@pytest.fixture
+def train(no_database) -> Train:
+    return Train(target_type="take_profit")
+
+
+def get_row_pnl(train: Train, row: pd.Series) -> float:
+    """Row-wise P&L the NumPy kernel replaced"""
+    row = row.fillna(False)
+    if row["model_buy"]:
+        if row["day_drawdown"] < train.stop_loss:
+            return train.stop_loss
+        if row["day_peak"] > train.take_profit:
+            return train.take_profit
+        return row["day_return"]
+    return 0
+
+
+def get_loop_balance(train: Train, df: pd.DataFrame) -> list[float]:
+    """Balance after every row, compounded one trade at a time"""
+    balance = train.starting_balance
+    balances = []
+    for _, row in df.iterrows():
+        if row["model_buy"]:
+            balance += balance * get_row_pnl(train, row)
+        balances.append(balance)
+    return balances
+
+
+def test_get_pnl_matches_row_loop(train, trades):
+    expected = trades.apply(lambda row: get_row_pnl(train, row), axis=1)
+    np.testing.assert_allclose(train.get_pnl(trades), expected.to_numpy(float))
+
+
+def test_simulate_trades_matches_balance_loop(train, trades):
+    final_pnl, equity_curve = train.simulate_trades(trades)
+    balances = get_loop_balance(train, trades)
+    np.testing.assert_allclose(equity_curve, balances, rtol=1e-12)
+    assert final_pnl == pytest.approx(balances[-1] / train.starting_balance - 1)
+
+
+def test_simulate_trades_without_trades(train, trades):
+    final_pnl, equity_curve = train.simulate_trades(trades.iloc[:0])
+    assert final_pnl == 0.0 and not len(equity_curve)
+    final_pnl, _ = train.simulate_trades(trades.assign(model_buy=False))
+    assert final_pnl == 0.0
+
+
+@pytest.mark.parametrize("window_type", ["expanding", "rolling"])
+def test_walk_forward_windows_follow_date_boundaries(train, trades, window_type):
+    # pairs listed on some days only, so that dates have different row counts
+    train.pre_processed_df = trades.sample(frac=0.8, random_state=0)
+    train.sort_by_date()
+    dates = train.dates
+    n_dates = len(train.unique_dates)
+    first_test = int(n_dates * (train.train_size + train.validate_size))
+    windows = train.get_walk_forward_windows(n_windows=3, window_type=window_type)
+
+    assert len(windows) == 3
+    assert windows[0]["test_rows"].start == np.searchsorted(
+        dates, train.unique_dates[first_test]
+    )
+    assert windows[-1]["test_rows"].stop == len(dates)
+    for window, next_window in zip(windows, windows[1:]):
+        assert window["test_rows"].stop == next_window["test_rows"].start
+    for window in windows:
+        train_rows, stopping_rows, test_rows = window.values()
+        assert train_rows.stop == stopping_rows.start
+        assert stopping_rows.stop == test_rows.start
+        # no date is split between two parts of a window
+        for boundary in (train_rows.start, stopping_rows.start, test_rows.start):
+            assert boundary == 0 or dates[boundary - 1] < dates[boundary]
+        trained_dates = np.unique(dates[train_rows.start : stopping_rows.stop])
+        assert trained_dates.max() < dates[test_rows].min()
+        if window_type == "expanding":
+            assert train_rows.start == 0
+        else:
+            assert len(trained_dates) == first_test
+
+
+def test_training_records_gain_and_permutation_importances(train, trades, monkeypatch):
+    async def pre_process_data(pairs: list[str] = None):
+        train.pre_processed_df = trades.drop(columns="model_buy").assign(
+            hit_take_profit=trades["model_buy"]
+        )
+
+    def fit_model():
+        train_x, train_y, _, _, _, _ = train.get_datasets()
+        model = xgb.XGBClassifier(n_estimators=5).fit(train_x, train_y)
+        return model, 0.5, ""
+
+    monkeypatch.setattr(train, "pre_process_data", pre_process_data)
+    monkeypatch.setattr(train, "fit_model", fit_model)
+    monkeypatch.setattr(train, "save_model_and_metadata", lambda **kwargs: None)
+    # without feature selection, the importances are recorded but nothing is pruned
+    asyncio.run(train.train(with_optimization=False))
+    importances = train.feature_importances
+    assert importances.columns.tolist() == [
+        "total_gain",
+        "permutation_mean",
+        "permutation_std",
+    ]
+    assert sorted(importances.index) == sorted(train.get_training_columns("features"))
+    # shuffling the column the target was derived from lowers the validation AUC
+    assert importances["permutation_mean"].idxmax() == "prediction"
+    assert train.selected_features is None
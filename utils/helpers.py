@@ -1,24 +1,29 @@
+from __future__ import annotations
+
 import asyncio
+import functools
 import logging
 import os
 import pickle
-import time
-from datetime import datetime as dt, timedelta
+from datetime import datetime as dt
 from pathlib import Path
-
-import aiohttp
-import boto3
-import ccxt
+from typing import TYPE_CHECKING
 
 # import django
 # import environ
-import pandas as pd
-import sqlalchemy as sql
-from botocore.exceptions import ClientError
-from ccxt import async_support as async_ccxt
 from dotenv import load_dotenv
-from tenacity import retry, stop_after_attempt
-from xgboost import XGBClassifier
+
+from utils.retries import a_call_with_retries, call_with_retries
+
+# heavy dependencies are imported where they are used, so that importing helpers
+# stays cheap for services that don't need them
+if TYPE_CHECKING:
+    import ccxt
+    import pandas as pd
+    import sqlalchemy as sql
+    from ccxt import async_support as async_ccxt
+    from botocore.client import BaseClient
+    from xgboost import XGBClassifier
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 ENV_PATH = BASE_DIR / ".env"
@@ -38,11 +43,29 @@ UNITS_TO_MILLISECONDS = {
 }
 
 MAX_OHLCV_SIZE = 300
+# candles requested when the exchange does not describe its maximum page size
+OHLCV_PROBE_SIZE = 1000
+MAX_CONCURRENT_OHLCV_REQUESTS = 5
+OHLCV_FETCH_ATTEMPTS = 5
+S3_ATTEMPTS = 3
+
+DB_POOL_SIZE = 5
+DB_MAX_OVERFLOW = 10
 
-THROTLE_PERIOD = 1
-MAX_RETRIES = 20
 
-S3_CLIENT = boto3.client("s3", region_name=os.getenv("PREFERRED_AWS_REGION"))
+@functools.cache
+def get_s3_client() -> BaseClient:
+    """Created on first use, boto3 takes a while to import and set up"""
+    import boto3
+
+    return boto3.client("s3", region_name=os.getenv("PREFERRED_AWS_REGION"))
+
+
+def __getattr__(name: str):
+    # S3_CLIENT used to be created at import time
+    if name == "S3_CLIENT":
+        return get_s3_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def get_api_keys(exchange: str, websocket: bool = False) -> dict:
@@ -62,6 +85,9 @@ def get_api_keys(exchange: str, websocket: bool = False) -> dict:
 def get_exchange_object(
     exchange: str, async_mode: bool
 ) -> ccxt.Exchange or async_ccxt.Exchange:
+    import ccxt
+    from ccxt import async_support as async_ccxt
+
     module = async_ccxt if async_mode else ccxt
     exchange_class = getattr(module, exchange)
     options = dict()
@@ -72,19 +98,35 @@ def get_exchange_object(
     return exchange_class(options)
 
 
+@functools.cache
 def get_db_connection() -> sql.Engine:
+    """
+    One pooled engine per process. A forked child drops the pooled connections it
+    inherited, without closing them for the parent, and opens its own.
+    """
+    import sqlalchemy as sql
+
     user = os.getenv("DB_USER")
     pwd = os.getenv("POSTGRES_PASSWORD")
     db_name = os.getenv("DB_NAME")
     host = os.getenv("DB_HOST")
     port = os.getenv("DB_PORT")
     dsn = f"postgresql://{user}:{pwd}@{host}:{port}/{db_name}"
-    return sql.create_engine(dsn)
+    engine = sql.create_engine(
+        dsn,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_pre_ping=True,
+    )
+    os.register_at_fork(after_in_child=lambda: engine.dispose(close=False))
+    return engine
 
 
 def datetime_unix_conversion(
     df: pd.DataFrame, convert_to: str, cols: list = None
 ) -> pd.DataFrame:
+    import pandas as pd
+
     cols = cols if cols else df.columns
     for col in cols:
         if col.endswith("tmstmp"):
@@ -95,14 +137,6 @@ def datetime_unix_conversion(
     return df
 
 
-async def async_get(session: aiohttp.ClientSession, url: str, pair: str = None) -> list:
-    async with session.get(url) as response:
-        data = await response.json()
-        if pair:
-            return [pair, data]
-        return data
-
-
 def get_logger(logger_name: str) -> logging.Logger:
     logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
     logger = logging.getLogger(logger_name)
@@ -110,100 +144,87 @@ def get_logger(logger_name: str) -> logging.Logger:
     return logger
 
 
-def call_with_retries(func):
-    def wrapper(*args, **kwargs):
-        success = False
-        retry_i = 0
-        while not success and retry_i <= MAX_RETRIES:
-            try:
-                response = func(*args, **kwargs)
-                success = True
-                return response
-            except Exception as e:
-                retry_i += 1
-                logging.warning(
-                    f"\n Attempt {retry_i} | Will retry in {THROTLE_PERIOD} seconds | {e} \n"
-                )
-                time.sleep(THROTLE_PERIOD)
-
-    return wrapper
-
-
-def a_call_with_retries(func):
-    async def wrapper(*args, **kwargs):
-        success = False
-        retry_i = 0
-        while not success and retry_i <= MAX_RETRIES:
-            try:
-                response = await func(*args, **kwargs)
-                success = True
-                return response
-            except Exception as e:
-                retry_i += 1
-                logging.warning(
-                    f"\n Attempt {retry_i} | Will retry in {THROTLE_PERIOD} seconds | {e} \n"
-                )
-                await asyncio.sleep(THROTLE_PERIOD)
-
-    return wrapper
-
-
-@retry(stop=stop_after_attempt(3))
-def _fetch_ohlcv(
-    exchange: ccxt.Exchange, pair: str, timeframe: str, limit: int, from_tmstmp: int
-):
-    return exchange.fetch_ohlcv(
+def get_ohlcv_page_size(exchange: ccxt.Exchange or async_ccxt.Exchange) -> int | None:
+    """Maximum candles per fetch_ohlcv request, when ccxt describes it"""
+    features = getattr(exchange, "features", None) or dict()
+    spot_features = features.get("spot") or dict()
+    return (spot_features.get("fetchOHLCV") or dict()).get("limit")
+
+
+@a_call_with_retries(max_attempts=OHLCV_FETCH_ATTEMPTS)
+async def _a_fetch_ohlcv(
+    exchange: async_ccxt.Exchange,
+    pair: str,
+    timeframe: str,
+    limit: int,
+    from_tmstmp: int = None,
+) -> list:
+    return await exchange.fetch_ohlcv(
         symbol=pair, timeframe=timeframe, limit=limit, since=from_tmstmp
     )
 
 
-def get_ohlcv_history(
+async def a_get_ohlcv_history(
     pair: str,
-    exchange: ccxt.Exchange,
+    exchange: async_ccxt.Exchange,
     timeframe: str,
     from_tmstmp: int = None,
-    full_history: bool = False,
+    max_concurrent_requests: int = MAX_CONCURRENT_OHLCV_REQUESTS,
 ) -> list:
-    limit = 200
+    """
+    History of the pair since from_tmstmp, or since its listing when None. The
+    latest page gives the page size when ccxt doesn't (exchanges cap the limit to
+    their maximum), older pages are fetched as batches of concurrent non-overlapping
+    time windows, throttled by ccxt's rate limiter. Candles are de-duplicated by
+    timestamp and sorted.
+    """
+    page_size = get_ohlcv_page_size(exchange)
+    latest_page = await _a_fetch_ohlcv(
+        exchange, pair, timeframe, limit=page_size or OHLCV_PROBE_SIZE
+    )
+    if not latest_page:
+        return latest_page
+    page_size = page_size or len(latest_page)
     time_unit = timeframe[-1:]
     time_multiplier = int(timeframe[:-1])
-    all_history_fetched = False
-    ohlc_data = list()
-    full_history = full_history
-
+    page_duration = page_size * UNITS_TO_MILLISECONDS[time_unit] * time_multiplier
+    semaphore = asyncio.Semaphore(max_concurrent_requests)
+
+    async def fetch_window(window_start: int, window_end: int) -> list:
+        async with semaphore:
+            candles = await _a_fetch_ohlcv(
+                exchange, pair, timeframe, limit=page_size, from_tmstmp=window_start
+            )
+        return [candle for candle in candles if candle[0] < window_end]
+
+    candles = {candle[0]: candle for candle in latest_page}
+    oldest_tmstmp = latest_page[0][0]
+    all_history_fetched = len(latest_page) < page_size or (
+        from_tmstmp is not None and oldest_tmstmp <= from_tmstmp
+    )
     while not all_history_fetched:
-        _ohlc_data = exchange.fetch_ohlcv(
-            symbol=pair, timeframe=timeframe, limit=limit, since=from_tmstmp
+        windows = list()
+        for i in range(max_concurrent_requests):
+            window_end = oldest_tmstmp - i * page_duration
+            window_start = window_end - page_duration
+            if from_tmstmp is not None:
+                if window_end <= from_tmstmp:
+                    break
+                window_start = max(window_start, from_tmstmp)
+            windows.append((window_start, window_end))
+        pages = await asyncio.gather(*[fetch_window(*window) for window in windows])
+        for page in pages:
+            candles.update({candle[0]: candle for candle in page})
+        oldest_tmstmp = windows[-1][0]
+        # an empty oldest window means the pair was not listed yet
+        all_history_fetched = not pages[-1] or (
+            from_tmstmp is not None and oldest_tmstmp <= from_tmstmp
         )
-        if not _ohlc_data:
-            return _ohlc_data
-        else:
-            if full_history:
-                oldest_tmstmp = _ohlc_data[0][0]
-                new_from_tmstmp = oldest_tmstmp - (
-                    limit * UNITS_TO_MILLISECONDS[time_unit] * time_multiplier
-                )
-                all_history_fetched = (
-                    True
-                    if new_from_tmstmp == from_tmstmp or len(_ohlc_data) < limit
-                    else False
-                )
-                if not all_history_fetched:
-                    from_tmstmp = new_from_tmstmp
-            else:
-                if len(_ohlc_data) <= 1:
-                    all_history_fetched = True
-                else:
-                    time_delta = (_ohlc_data[1][0] - _ohlc_data[0][0]) / 1000
-                    latest_tmstmp = int(_ohlc_data[len(_ohlc_data) - 1][0])
-                    if dt.now() - timedelta(seconds=time_delta) > dt.fromtimestamp(
-                        latest_tmstmp / 1000
-                    ):
-                        from_tmstmp = latest_tmstmp
-                    else:
-                        all_history_fetched = True
-            ohlc_data += _ohlc_data
-    return ohlc_data
+    return [
+        candles[tmstmp]
+        for tmstmp in sorted(candles)
+        if from_tmstmp is None or tmstmp >= from_tmstmp
+    ]
 
 
 def write_file_to_s3(
@@ -215,15 +236,41 @@ def write_file_to_s3(
     else:
         with open(path, "w") as f:
             f.write(content_to_write)
+    upload_to_s3(local_path)
+
+
+def upload_to_s3(local_path: str):
     bucket_name = "cmetrics-ai"
-    file_name = path.name
-    S3_CLIENT.upload_file(Filename=local_path, Bucket=bucket_name, Key=file_name)
+    file_name = Path(local_path).name
+    upload_file = call_with_retries(
+        get_s3_client().upload_file, max_attempts=S3_ATTEMPTS
+    )
+    upload_file(Filename=local_path, Bucket=bucket_name, Key=file_name)
+
+
+def get_s3_etag(file_name: str) -> str | None:
+    """ETag of the stored file, None when it is missing or S3 can't be reached"""
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    bucket_name = "cmetrics-ai"
+    head_object = call_with_retries(
+        get_s3_client().head_object, max_attempts=S3_ATTEMPTS
+    )
+    try:
+        return head_object(Bucket=bucket_name, Key=file_name)["ETag"]
+    except (ClientError, BotoCoreError):
+        return None
 
 
 def load_from_s3(file_name: str):
+    from botocore.exceptions import BotoCoreError, ClientError
+
     bucket_name = "cmetrics-ai"
     local_path = f"./services/ai/assets/{file_name}"
+    download_file = call_with_retries(
+        get_s3_client().download_file, max_attempts=S3_ATTEMPTS
+    )
     try:
-        S3_CLIENT.download_file(bucket_name, file_name, local_path)
-    except ClientError:
+        download_file(bucket_name, file_name, local_path)
+    except (ClientError, BotoCoreError):
         print(f"Could not download '{file_name}' file from S3")
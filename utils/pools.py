@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import weakref
+from typing import TYPE_CHECKING
+from urllib.parse import urlparse
+
+from utils.helpers import get_exchange_object
+from utils.retries import a_call_with_retries, call_with_retries
+
+if TYPE_CHECKING:
+    import aiohttp
+    import ccxt
+    import requests
+    from ccxt import async_support as async_ccxt
+
+HTTP_POOL_SIZE = 20
+HTTP_TIMEOUT = 30
+
+_LOCK = threading.Lock()
+_EXCHANGES: dict[str, ccxt.Exchange] = dict()
+_HTTP_SESSION: requests.Session | None = None
+# async clients are bound to the event loop they were created on
+_LOOP_POOLS: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict] = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_exchange(exchange: str) -> ccxt.Exchange:
+    """Long-lived ccxt client per exchange, with its markets loaded once"""
+    with _LOCK:
+        if exchange not in _EXCHANGES:
+            exchange_object = get_exchange_object(exchange, async_mode=False)
+            call_with_retries(exchange_object.load_markets)()
+            _EXCHANGES[exchange] = exchange_object
+        return _EXCHANGES[exchange]
+
+
+def get_http_session() -> requests.Session:
+    """Keep-alive session shared by the synchronous API calls"""
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    global _HTTP_SESSION
+    with _LOCK:
+        if _HTTP_SESSION is None:
+            _HTTP_SESSION = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE
+            )
+            _HTTP_SESSION.mount("https://", adapter)
+            _HTTP_SESSION.mount("http://", adapter)
+        return _HTTP_SESSION
+
+
+def get_json(url: str, headers: dict = None):
+    """GET on the shared session, throttled and retried per host"""
+
+    def fetch():
+        response = get_http_session().get(url, headers=headers, timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+        return response.json()
+
+    return call_with_retries(fetch, host=urlparse(url).hostname)()
+
+
+def _get_loop_pool() -> dict:
+    loop = asyncio.get_running_loop()
+    if loop not in _LOOP_POOLS:
+        _LOOP_POOLS[loop] = dict(
+            lock=asyncio.Lock(), exchanges=dict(), http_session=None
+        )
+    return _LOOP_POOLS[loop]
+
+
+async def a_get_exchange(exchange: str) -> async_ccxt.Exchange:
+    """Long-lived async ccxt client per exchange and event loop, markets loaded"""
+    pool = _get_loop_pool()
+    async with pool["lock"]:
+        if exchange not in pool["exchanges"]:
+            exchange_object = get_exchange_object(exchange, async_mode=True)
+            await a_call_with_retries(exchange_object.load_markets)()
+            pool["exchanges"][exchange] = exchange_object
+        return pool["exchanges"][exchange]
+
+
+async def a_get_http_session() -> aiohttp.ClientSession:
+    """Keep-alive aiohttp session shared by the calls of the running event loop"""
+    import aiohttp
+
+    pool = _get_loop_pool()
+    async with pool["lock"]:
+        if pool["http_session"] is None or pool["http_session"].closed:
+            pool["http_session"] = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE)
+            )
+        return pool["http_session"]
+
+
+async def close_async_clients():
+    """Closes the async clients of the running event loop, before it is closed"""
+    pool = _LOOP_POOLS.pop(asyncio.get_running_loop(), None)
+    if pool is None:
+        return
+    for exchange_object in pool["exchanges"].values():
+        await exchange_object.close()
+    if pool["http_session"] is not None:
+        await pool["http_session"].close()
+
+
+async def a_get_json(url: str, headers: dict = None):
+    """GET on the event loop's shared session, throttled and retried per host"""
+    import aiohttp
+
+    async def fetch():
+        session = await a_get_http_session()
+        async with session.get(
+            url,
+            headers=headers,
+            raise_for_status=True,
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+        ) as response:
+            return await response.json()
+
+    return await a_call_with_retries(fetch, host=urlparse(url).hostname)()
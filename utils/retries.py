@@ -0,0 +1,225 @@
+import asyncio
+import functools
+import logging
+import random
+import sys
+import threading
+import time
+from datetime import datetime as dt, timezone
+from email.utils import parsedate_to_datetime
+
+MAX_ATTEMPTS = 6
+BASE_BACKOFF = 0.5
+MAX_BACKOFF = 30
+
+RETRYABLE_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+# requests per second allowed by each host, DEFAULT_RATE_LIMIT for the others
+HOST_RATE_LIMITS = {
+    "api.coinalyze.net": 40 / 60,
+    "pro-api.coinmarketcap.com": 30 / 60,
+    "api.alternative.me": 1,
+}
+DEFAULT_RATE_LIMIT = 5
+
+LOG = logging.getLogger("retries")
+
+
+class TokenBucket:
+    """
+    rate requests per second with bursts of up to capacity requests. Tokens are
+    reserved under a lock and the caller sleeps for the returned delay, so the
+    same bucket throttles threads and coroutines.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        # no token is handed out before this time (Retry-After)
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Takes a token and returns how long to wait before using it"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated_at) * self.rate
+            )
+            self.updated_at = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(wait, self.blocked_until - now)
+
+    def block(self, delay: float):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+
+    def acquire(self):
+        time.sleep(self.reserve())
+
+    async def a_acquire(self):
+        await asyncio.sleep(self.reserve())
+
+
+_BUCKETS: dict[str, TokenBucket] = dict()
+_BUCKETS_LOCK = threading.Lock()
+
+
+def get_bucket(host: str) -> TokenBucket:
+    with _BUCKETS_LOCK:
+        if host not in _BUCKETS:
+            _BUCKETS[host] = TokenBucket(HOST_RATE_LIMITS.get(host, DEFAULT_RATE_LIMIT))
+        return _BUCKETS[host]
+
+
+def get_retryable_errors() -> tuple[type[Exception], ...]:
+    """
+    Error types of the network libraries already imported: an error can only come
+    from a loaded library, and checking doesn't import the others
+    """
+    errors = [asyncio.TimeoutError, ConnectionError]
+    if "ccxt" in sys.modules:
+        errors.append(sys.modules["ccxt"].NetworkError)
+    if "requests" in sys.modules:
+        requests = sys.modules["requests"]
+        errors.extend([requests.ConnectionError, requests.Timeout])
+    if "aiohttp" in sys.modules:
+        aiohttp = sys.modules["aiohttp"]
+        errors.extend([aiohttp.ClientConnectionError, aiohttp.ServerTimeoutError])
+    if "botocore.exceptions" in sys.modules:
+        botocore_exceptions = sys.modules["botocore.exceptions"]
+        errors.extend(
+            [botocore_exceptions.ConnectionError, botocore_exceptions.HTTPClientError]
+        )
+    return tuple(errors)
+
+
+def get_response_details(error: Exception) -> tuple[int | None, dict | None]:
+    """HTTP status and headers of requests, aiohttp and botocore response errors"""
+    if "requests" in sys.modules and isinstance(
+        error, sys.modules["requests"].HTTPError
+    ):
+        if error.response is not None:
+            return error.response.status_code, error.response.headers
+    if "aiohttp" in sys.modules and isinstance(
+        error, sys.modules["aiohttp"].ClientResponseError
+    ):
+        return error.status, error.headers
+    if "botocore.exceptions" in sys.modules and isinstance(
+        error, sys.modules["botocore.exceptions"].ClientError
+    ):
+        metadata = error.response.get("ResponseMetadata", dict())
+        # botocore lowercases the header names
+        headers = {
+            name.title(): value
+            for name, value in metadata.get("HTTPHeaders", dict()).items()
+        }
+        return metadata.get("HTTPStatusCode"), headers
+    return None, None
+
+
+def is_retryable(error: Exception) -> bool:
+    """Connection problems, timeouts, rate limits and server errors"""
+    status, _ = get_response_details(error)
+    if status is not None:
+        return status in RETRYABLE_STATUSES
+    return isinstance(error, get_retryable_errors())
+
+
+def get_retry_after(error: Exception) -> float | None:
+    """Seconds requested by the server's Retry-After header (delay or HTTP date)"""
+    _, headers = get_response_details(error)
+    if not headers:
+        return None
+    retry_after = headers.get("Retry-After")
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - dt.now(tz=timezone.utc)).total_seconds())
+
+
+def get_backoff(attempt: int) -> float:
+    """Exponential backoff with full jitter, so that clients don't retry in step"""
+    return random.uniform(0, min(MAX_BACKOFF, BASE_BACKOFF * 2**attempt))
+
+
+def get_retry_delay(error: Exception, attempt: int, host: str = None) -> float:
+    """
+    Delay before the next attempt, the server's Retry-After when it sets one (the
+    host's bucket is then blocked for every caller)
+    """
+    retry_after = get_retry_after(error)
+    if retry_after is None:
+        return get_backoff(attempt)
+    if host:
+        get_bucket(host).block(retry_after)
+    return retry_after
+
+
+def call_with_retries(func=None, *, host: str = None, max_attempts: int = MAX_ATTEMPTS):
+    """
+    Retries retryable errors with backoff, throttled by the host's token bucket
+    when a host is given. Other errors, and the last one, are raised.
+    """
+    if func is None:
+        return functools.partial(
+            call_with_retries, host=host, max_attempts=max_attempts
+        )
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(max_attempts):
+            if host:
+                get_bucket(host).acquire()
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if attempt == max_attempts - 1 or not is_retryable(e):
+                    raise
+                delay = get_retry_delay(e, attempt, host)
+                LOG.warning(
+                    f"Attempt {attempt + 1} of {func.__name__} failed, "
+                    f"retrying in {delay:.1f} seconds | {e}"
+                )
+                time.sleep(delay)
+
+    return wrapper
+
+
+def a_call_with_retries(
+    func=None, *, host: str = None, max_attempts: int = MAX_ATTEMPTS
+):
+    """Coroutine version of call_with_retries"""
+    if func is None:
+        return functools.partial(
+            a_call_with_retries, host=host, max_attempts=max_attempts
+        )
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        for attempt in range(max_attempts):
+            if host:
+                await get_bucket(host).a_acquire()
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                if attempt == max_attempts - 1 or not is_retryable(e):
+                    raise
+                delay = get_retry_delay(e, attempt, host)
+                LOG.warning(
+                    f"Attempt {attempt + 1} of {func.__name__} failed, "
+                    f"retrying in {delay:.1f} seconds | {e}"
+                )
+                await asyncio.sleep(delay)
+
+    return wrapper